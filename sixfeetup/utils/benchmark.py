@@ -0,0 +1,233 @@
+"""Benchmarks for the bulk helpers
+
+Builds synthetic Plone sites of the given sizes (folders of documents,
+some of them locked or referencing each other, and members) and times
+the bulk helpers against them. Everything happens in a DemoStorage on top
+of the instance's database, so nothing is written to the real storage.
+
+Run it with the instance script, e.g.::
+
+  bin/instance run src/sixfeetup.utils/sixfeetup/utils/benchmark.py \\
+      --size 1000 --size 10000 --output benchmark.json
+
+Every helper gets its wall and CPU time, objects/sec, ZODB loads and
+stores and the peak RSS of the process (a high-water mark for the whole
+run, so compare runs of the same size) in the JSON output.
+
+Pass --import-time to also time importing the package modules in fresh
+interpreters.
+"""
+import gc
+import logging
+import os
+import subprocess
+import sys
+import time
+import transaction
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+        # Plone < 4.3
+            from zope.app.component.hooks import setSite
+except ImportError:
+        # Plone >= 4.3
+            from zope.component.hooks import setSite # NOQA
+
+from Products.CMFCore.utils import getToolByName
+from sixfeetup.utils import helpers
+from sixfeetup.utils.instrumentation import instrument
+from sixfeetup.utils.parallel import openApp
+
+logger = logging.getLogger(__name__)
+
+
+def openDemoApp(app):
+    """Open the application from a DemoStorage wrapping app's storage
+    """
+    from ZODB.DB import DB
+    from ZODB.DemoStorage import DemoStorage
+    base = app._p_jar.db().storage
+    return openApp(DB(DemoStorage(base=base)))
+
+
+def buildSyntheticSite(app, size=1000, folder_size=100, lock_every=100,
+                       reference_every=10, members=100, site_id=None,
+                       extension_ids=()):
+    """Add a Plone site with size documents
+
+    The documents are spread over folders of folder_size documents, every
+    lock_every-th document is locked and every reference_every-th document
+    references the previous one. members members are added.
+    """
+    from Products.CMFPlone.factory import addPloneSite
+    from plone.locking.interfaces import ILockable
+    if site_id is None:
+        site_id = 'benchmark-%d' % size
+    started = time.time()
+    site = addPloneSite(app, site_id, extension_ids=extension_ids)
+    setSite(site)
+    transaction.commit()
+    count = 0
+    previous = None
+    folder_num = 0
+    while count < size:
+        folder_id = 'folder-%d' % folder_num
+        site.invokeFactory('Folder', folder_id)
+        folder = site[folder_id]
+        for i in range(min(folder_size, size - count)):
+            doc_id = 'doc-%d' % count
+            folder.invokeFactory('Document', doc_id,
+                                 title='Document %d' % count)
+            doc = folder[doc_id]
+            if lock_every and not count % lock_every:
+                ILockable(doc).lock()
+            if reference_every and previous is not None and \
+                    not count % reference_every:
+                doc.addReference(previous, 'benchmark')
+            previous = doc
+            count += 1
+        transaction.commit()
+        site._p_jar.cacheGC()
+        folder_num += 1
+    rtool = getToolByName(site, 'portal_registration')
+    for i in range(members):
+        rtool.addMember('member-%d' % i, 'secret-%d' % i, ['Member'],
+                        properties={'email': 'member-%d@example.com' % i})
+    transaction.commit()
+    logger.info('Built %s with %d documents in %.1fs', site_id, size,
+                time.time() - started)
+    return site
+
+
+def timeHelper(name, func, *args, **kw):
+    """Run func and return its metrics
+
+    objects is taken from what the helpers count, falling back to the
+    'objects' keyword argument for helpers that don't count.
+    """
+    objects = kw.pop('objects', 0)
+    gc.collect()
+    with instrument('benchmark %s' % name) as record:
+        func(*args, **kw)
+        transaction.commit()
+    if not record['objects']:
+        record['objects'] = objects
+    record['name'] = name
+    record['objects_per_sec'] = record['wall'] and \
+        record['objects'] / record['wall'] or 0.0
+    logger.info('%(name)s: %(objects)d objects in %(wall).2fs '
+                '(%(objects_per_sec).1f objects/sec)', record)
+    return record
+
+
+def _listReferences(site):
+    from sixfeetup.utils.browser.references import ReferenceUtils
+    pc = getToolByName(site, 'portal_catalog')
+    count = 0
+    for brain in pc.unrestrictedSearchResults(portal_type='Document'):
+        doc = brain._unrestrictedGetObject()
+        view = ReferenceUtils(doc, site.REQUEST)
+        view.getFilteredRefs(doc, 'benchmark', sort_on='title')
+        view.getFilteredBRefs(doc, 'benchmark', sort_on='title')
+        count += 1
+    return count
+
+
+def benchmarkSite(site, size, members=100):
+    """Time the bulk helpers against a synthetic site
+    """
+    setSite(site)
+    new_members = [{
+        'id': 'bench-%d' % i,
+        'password': 'secret-%d' % i,
+        'roles': ['Member'],
+        'properties': {'email': 'bench-%d@example.com' % i},
+    } for i in range(members)]
+    results = [
+        timeHelper('publishEverything', helpers.publishEverything,
+                   batch_size=1000),
+        timeHelper('clearLocks', helpers.clearLocks),
+        timeHelper('updateCatalog', helpers.updateCatalog, objects=size),
+        timeHelper('clearAndRebuildCatalog', helpers.clearAndRebuildCatalog,
+                   objects=size),
+        timeHelper('addUserAccounts', helpers.addUserAccounts, new_members),
+        timeHelper('ReferenceUtils', _listReferences, site, objects=size),
+    ]
+    return results
+
+
+IMPORT_SCRIPT = """\
+import time
+started = time.time()
+import %s
+print time.time() - started
+"""
+
+
+def benchmarkImportTime(modules=('sixfeetup.utils.helpers',
+                                 'sixfeetup.utils.browser.references'),
+                        repeat=5):
+    """Time importing each module in a fresh interpreter
+
+    Returns a dictionary with the best of repeat runs for each module.
+    The numbers are only meaningful compared with a run of another
+    checkout in the same buildout.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    results = {}
+    for module in modules:
+        times = []
+        for i in range(repeat):
+            output = subprocess.Popen(
+                [sys.executable, '-c', IMPORT_SCRIPT % module],
+                stdout=subprocess.PIPE, env=env).communicate()[0]
+            times.append(float(output.strip().splitlines()[-1]))
+        results[module] = min(times)
+        logger.info('import %s: %.3fs', module, results[module])
+    return results
+
+
+def main(app, argv=None):
+    parser = OptionParser(usage='%prog [--size N]... [--output FILE]')
+    parser.add_option('--size', type='int', action='append', dest='sizes',
+                      help='number of documents, can be repeated')
+    parser.add_option('--folder-size', type='int', default=100)
+    parser.add_option('--members', type='int', default=100)
+    parser.add_option('--output', help='file to write the JSON results to')
+    parser.add_option('--import-time', action='store_true', default=False,
+                      help='also time importing the package modules')
+    options, args = parser.parse_args(argv)
+    sizes = options.sizes or [1000]
+
+    demo = openDemoApp(app)
+    report = {'started': time.time(), 'runs': []}
+    for size in sizes:
+        site = buildSyntheticSite(demo, size, options.folder_size,
+                                  members=options.members)
+        report['runs'].append({
+            'size': size,
+            'results': benchmarkSite(site, size, options.members),
+        })
+    if options.import_time:
+        report['import_time'] = benchmarkImportTime()
+    data = json.dumps(report, sort_keys=True, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    else:
+        print data
+    transaction.abort()
+    return report
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # app is provided by bin/instance run
+    main(app, sys.argv[1:]) # NOQA
@@ -0,0 +1,13 @@
+from Products.Five import BrowserView
+from sixfeetup.utils.browser.monkeypatch import tracker
+
+
+class MissingAssets(BrowserView):
+    """List the js/css that threw a 404 the most, with their hits
+    """
+
+    def __call__(self, limit=50):
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        lines = ['%8d  %s' % (hits, entry)
+                 for entry, hits in tracker.top(int(limit))]
+        return '\n'.join(lines)
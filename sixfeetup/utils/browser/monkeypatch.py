@@ -1,11 +1,87 @@
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urlparse import urlparse
 logger = logging.getLogger("sixfeetup.utils")
 
+ASSET_EXTENSIONS = ('.js', '.css')
+
+
+class MissingAssetTracker(object):
+    """Count the js/css that threw a 404 instead of logging every one
+
+    The max_entries most recently missed entries are kept with their hit
+    counts, and a summary with the top entries is logged at most every
+    interval seconds.
+    """
+
+    def __init__(self, max_entries=500, interval=300, top=10):
+        self.max_entries = max_entries
+        self.interval = interval
+        self.top_size = top
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.pending = 0
+        self.last_summary = 0
+
+    def hit(self, entry):
+        self.lock.acquire()
+        try:
+            count = self.entries.pop(entry, 0) + 1
+            self.entries[entry] = count
+            if len(self.entries) > self.max_entries:
+                # forget the least recently missed entry
+                self.entries.popitem(last=False)
+            self.pending += 1
+            now = time.time()
+            if now - self.last_summary < self.interval:
+                return
+            pending = self.pending
+            self.pending = 0
+            self.last_summary = now
+            top = self._top(self.top_size)
+        finally:
+            self.lock.release()
+        logger.warn("%d js/css 404s since the last summary, we are bypassing "
+                    "the errors for sanity's sake. Most missed: %s", pending,
+                    ', '.join(['%s (%d)' % item for item in top]))
+
+    def _top(self, limit=None):
+        items = sorted(self.entries.items(), key=lambda item: item[1],
+                       reverse=True)
+        return items[:limit]
+
+    def top(self, limit=None):
+        """Return the (entry, hits) pairs of the most missed entries
+        """
+        self.lock.acquire()
+        try:
+            return self._top(limit)
+        finally:
+            self.lock.release()
+
+
+tracker = MissingAssetTracker()
+
+
+def isAsset(entry):
+    """Check if the extension of entry is one of ASSET_EXTENSIONS
+    """
+    if not isinstance(entry, basestring):
+        return False
+    path = urlparse(entry).path
+    return os.path.splitext(path)[1].lower() in ASSET_EXTENSIONS
+
 
 def notFoundError(self, entry='Unknown'):
     self.setStatus(404)
-    if 'js' in entry or 'css' in entry:
-        logger.warn("{0} threw a 404, but we are bypassing the error for sanity's sake".format(entry))
+    if isAsset(entry):
+        tracker.hit(entry)
 
 
 forbiddenError = notFoundError
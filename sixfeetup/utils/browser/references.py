@@ -1,28 +1,164 @@
+import heapq
+from itertools import islice
+from AccessControl import getSecurityManager
+from zope.annotation.interfaces import IAnnotations
 from zope.interface import implements, Interface
 from ZTUtils import LazyFilter
+from plone.memoize import ram
+from Products.CMFCore.utils import getToolByName
 from Products.Five import BrowserView
 
+MEMO_KEY = 'sixfeetup.utils.reference_utils'
+
 
 class IReferenceUtils(Interface):
     """Some utilities to get properly filtered refs
+
+    The results are remembered for the rest of the request. Pass
+    cached=True to also keep them in a RAM cache that is invalidated
+    whenever a reference or a catalog entry changes.
     """
 
-    def getFilteredRefs(obj, relationship, sort_on, reverse):
+    def getFilteredRefs(obj, relationship, sort_on, reverse, cached):
         """Get the references for an object and pass them through
         """
 
-    def getFilteredBRefs(obj, relationship, sort_on, reverse):
+    def getFilteredBRefs(obj, relationship, sort_on, reverse, cached):
         """Get the back references for an object and pass them through
         """
 
-    def getFilteredOrderedRefs(obj, relationship, reverse):
+    def getFilteredOrderedRefs(obj, relationship, reverse, cached):
         """Get ordered refs back from an OrderableRefField
         """
 
-    def getFilteredOrderedBRefs(obj, relationship, reverse):
+    def getFilteredOrderedBRefs(obj, relationship, reverse, cached):
         """Get ordered BRefs back from an OrderableRefField
         """
 
+    def getFilteredRefBrains(obj, relationship, sort_on, reverse, b_start,
+                             b_size):
+        """Get catalog brains for the references of an object
+
+        The targets are looked up with a single UID catalog query, so they
+        are not woken and the catalog filters them on View permission.
+        sort_on is a catalog index, pass b_size to get a page of b_size
+        brains starting at b_start.
+        """
+
+    def getFilteredBRefBrains(obj, relationship, sort_on, reverse, b_start,
+                              b_size):
+        """Get catalog brains for the back references of an object
+        """
+
+    def getFilteredOrderedRefBrains(obj, relationship, reverse, b_start,
+                                    b_size):
+        """Get catalog brains for the refs of an OrderableRefField, in order
+        """
+
+    def getFilteredOrderedBRefBrains(obj, relationship, reverse, b_start,
+                                     b_size):
+        """Get catalog brains for the BRefs of an OrderableRefField, in order
+        """
+
+    def getFilteredRefsBatch(obj, relationship, sort_on, reverse, start,
+                             size):
+        """Get a page of size references starting at start
+
+        Returns a LazyRefBatch, only the page is sorted (with a partial
+        sort) and its total is only counted when asked for. Without a
+        sort_on only the objects needed for the page are woken.
+        """
+
+    def getFilteredBRefsBatch(obj, relationship, sort_on, reverse, start,
+                              size):
+        """Get a page of size back references starting at start
+        """
+
+    def getFilteredOrderedRefsBatch(obj, relationship, reverse, start, size):
+        """Get a page of size ordered refs starting at start
+
+        Only the target objects needed for the page are woken.
+        """
+
+    def getFilteredOrderedBRefsBatch(obj, relationship, reverse, start,
+                                     size):
+        """Get a page of size ordered BRefs starting at start
+        """
+
+
+def _refsCacheKey(method, self, kind, obj, relationship, sort_on, reverse):
+    """Cache per user until a reference or catalog entry changes
+    """
+    counters = []
+    for name in ('reference_catalog', 'portal_catalog'):
+        catalog = getToolByName(obj, name, None)
+        getCounter = getattr(catalog, 'getCounter', None)
+        if getCounter is None:
+            raise ram.DontCache
+        counters.append(getCounter())
+    user = getSecurityManager().getUser()
+    return (kind, '/'.join(obj.getPhysicalPath()), relationship, sort_on,
+            reverse, tuple(counters), user.getId())
+
+
+def _orderKey(ref):
+    return getattr(ref, 'order', None)
+
+
+def _asList(refs):
+    if not refs:
+        return []
+    if not isinstance(refs, list):
+        return [refs]
+    return refs
+
+
+def _visible(objs):
+    """Only let through the objects the user can View, like LazyFilter
+    """
+    checkPermission = getSecurityManager().checkPermission
+    for obj in objs:
+        if obj is not None and checkPermission('View', obj):
+            yield obj
+
+
+def _counting(objs, counter):
+    for obj in objs:
+        counter[0] += 1
+        yield obj
+
+
+class LazyRefBatch(object):
+    """A page of references that knows how many references there are
+
+    The page is only computed when it is first used, and the total (the
+    number of references the user can View) only when it is asked for.
+    """
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    def __init__(self, page_func, total_func):
+        self._page_func = page_func
+        self._total_func = total_func
+        self._page = None
+
+    def _items(self):
+        if self._page is None:
+            self._page = self._page_func()
+        return self._page
+
+    def __iter__(self):
+        return iter(self._items())
+
+    def __len__(self):
+        return len(self._items())
+
+    def __getitem__(self, index):
+        return self._items()[index]
+
+    @property
+    def total(self):
+        return self._total_func()
+
 
 class ReferenceUtils(BrowserView):
     """see IReferenceUtils for documentation
@@ -38,34 +174,246 @@ class ReferenceUtils(BrowserView):
                 refs = [refs]
             filtered_refs = list(LazyFilter(refs, skip='View'))
         if sort_on is not None:
-            filtered_refs.sort(lambda x, y: cmp(x.getField(sort_on).get(x),
-                                                y.getField(sort_on).get(y)))
+            # get the field value only once per object
+            filtered_refs.sort(key=lambda x: x.getField(sort_on).get(x))
             if reverse:
                 filtered_refs.reverse()
         return filtered_refs
 
-    def getFilteredRefs(self, obj, relationship, sort_on=None, reverse=False):
+    def _computeRefs(self, kind, obj, relationship, sort_on, reverse):
+        if kind == 'refs':
+            refs = obj.getRefs(relationship)
+        elif kind == 'brefs':
+            refs = obj.getBRefs(relationship)
+        else:
+            if kind == 'ordered':
+                refs = obj.getReferenceImpl(relationship)
+            else:
+                refs = obj.getBackReferenceImpl(relationship)
+            refs.sort(key=_orderKey)
+            if kind == 'ordered':
+                refs = [ref.getTargetObject() for ref in refs]
+            else:
+                refs = [ref.getSourceObject() for ref in refs]
+        return self._processRefs(refs, sort_on, reverse)
+
+    @ram.cache(_refsCacheKey)
+    def _cachedPaths(self, kind, obj, relationship, sort_on, reverse):
+        refs = self._computeRefs(kind, obj, relationship, sort_on, reverse)
+        return tuple(['/'.join(ref.getPhysicalPath()) for ref in refs])
+
+    def _getRefs(self, kind, obj, relationship, sort_on, reverse, cached):
+        """Get the refs, remembering them for the rest of the request
+        """
+        memo = IAnnotations(self.request).setdefault(MEMO_KEY, {})
+        key = (kind, '/'.join(obj.getPhysicalPath()), relationship, sort_on,
+               reverse)
+        if key not in memo:
+            if cached:
+                paths = self._cachedPaths(kind, obj, relationship, sort_on,
+                                          reverse)
+                refs = [obj.unrestrictedTraverse(path, None)
+                        for path in paths]
+                memo[key] = [ref for ref in refs if ref is not None]
+            else:
+                memo[key] = self._computeRefs(kind, obj, relationship,
+                                              sort_on, reverse)
+        return list(memo[key])
+
+    def getFilteredRefs(self, obj, relationship, sort_on=None, reverse=False,
+                        cached=False):
         """see IReferenceUtils for documentation
         """
-        refs = obj.getRefs(relationship)
-        return self._processRefs(refs, sort_on, reverse)
+        return self._getRefs('refs', obj, relationship, sort_on, reverse,
+                             cached)
 
-    def getFilteredBRefs(self, obj, relationship, sort_on=None, reverse=False):
+    def getFilteredBRefs(self, obj, relationship, sort_on=None, reverse=False,
+                         cached=False):
         """see IReferenceUtils for documentation
         """
-        refs = obj.getBRefs(relationship)
-        return self._processRefs(refs, sort_on, reverse)
+        return self._getRefs('brefs', obj, relationship, sort_on, reverse,
+                             cached)
+
+    def getFilteredOrderedRefs(self, obj, relationship, reverse=False,
+                               cached=False):
+        return self._getRefs('ordered', obj, relationship, None, reverse,
+                             cached)
+
+    def getFilteredOrderedBRefs(self, obj, relationship, reverse=False,
+                                cached=False):
+        return self._getRefs('orderedb', obj, relationship, None, reverse,
+                             cached)
+
+    def _refUIDs(self, obj, relationship, back=False):
+        """Get the UIDs at the other end of the references from the
+        reference catalog, without waking any object
+        """
+        rc = getToolByName(obj, 'reference_catalog')
+        query = {}
+        if relationship is not None:
+            query['relationship'] = relationship
+        if back:
+            query['targetUID'] = obj.UID()
+            return [brain.sourceUID for brain in rc(query)]
+        query['sourceUID'] = obj.UID()
+        return [brain.targetUID for brain in rc(query)]
+
+    def _orderedRefUIDs(self, obj, relationship, back=False):
+        if back:
+            refs = obj.getBackReferenceImpl(relationship)
+        else:
+            refs = obj.getReferenceImpl(relationship)
+        refs.sort(key=_orderKey)
+        if back:
+            return [ref.sourceUID for ref in refs]
+        return [ref.targetUID for ref in refs]
+
+    def _refBrains(self, uids, sort_on=None, reverse=False, b_start=0,
+                   b_size=None, keep_order=False):
+        """Look up the brains for uids, the catalog takes care of the
+        View permission through allowedRolesAndUsers
+
+        Without a sort_on the brains are kept in the order of uids, like
+        the objects getFilteredRefs returns.
+        """
+        if not uids:
+            return []
+        if sort_on is None:
+            keep_order = True
+        pc = getToolByName(self.context, 'portal_catalog')
+        query = {'UID': uids}
+        if not keep_order:
+            query['sort_on'] = sort_on
+            if reverse:
+                query['sort_order'] = 'reverse'
+            if b_size:
+                query['sort_limit'] = b_start + b_size
+        brains = pc(query)
+        if keep_order:
+            positions = dict([(uid, i) for i, uid in enumerate(uids)])
+            brains = sorted(brains, key=lambda brain: positions[brain.UID])
+            if reverse:
+                brains.reverse()
+        if b_size:
+            return brains[b_start:b_start + b_size]
+        return brains[b_start:]
+
+    def getFilteredRefBrains(self, obj, relationship, sort_on=None,
+                             reverse=False, b_start=0, b_size=None):
+        """see IReferenceUtils for documentation
+        """
+        uids = self._refUIDs(obj, relationship)
+        return self._refBrains(uids, sort_on, reverse, b_start, b_size)
+
+    def getFilteredBRefBrains(self, obj, relationship, sort_on=None,
+                              reverse=False, b_start=0, b_size=None):
+        """see IReferenceUtils for documentation
+        """
+        uids = self._refUIDs(obj, relationship, back=True)
+        return self._refBrains(uids, sort_on, reverse, b_start, b_size)
+
+    def getFilteredOrderedRefBrains(self, obj, relationship, reverse=False,
+                                    b_start=0, b_size=None):
+        """see IReferenceUtils for documentation
+        """
+        uids = self._orderedRefUIDs(obj, relationship)
+        return self._refBrains(uids, None, reverse, b_start, b_size,
+                               keep_order=True)
 
-    def getFilteredOrderedRefs(self, obj, relationship, reverse=False):
-        refs = obj.getReferenceImpl(relationship)
-        refs.sort(
-            lambda a, b: cmp(getattr(a, 'order', None), getattr(b, 'order', None)))
-        ref_objs = [ref.getTargetObject() for ref in refs]
-        return self._processRefs(ref_objs, None, reverse)
-
-    def getFilteredOrderedBRefs(self, obj, relationship, reverse=False):
-        refs = obj.getBackReferenceImpl(relationship)
-        refs.sort(
-            lambda a, b: cmp(getattr(a, 'order', None), getattr(b, 'order', None)))
-        ref_objs = [ref.getTargetObject() for ref in refs]
-        return self._processRefs(ref_objs, None, reverse)
+    def getFilteredOrderedBRefBrains(self, obj, relationship, reverse=False,
+                                     b_start=0, b_size=None):
+        """see IReferenceUtils for documentation
+        """
+        uids = self._orderedRefUIDs(obj, relationship, back=True)
+        return self._refBrains(uids, None, reverse, b_start, b_size,
+                               keep_order=True)
+
+    def _batch(self, objs_func, sort_on, reverse, start, size):
+        """Build a LazyRefBatch out of objs_func, which returns a fresh
+        iterator over the (unfiltered) objects in their natural order
+        """
+        state = {}
+
+        def page():
+            visible = _visible(objs_func())
+            if sort_on is None:
+                if reverse:
+                    visible = reversed(list(visible))
+                return list(islice(visible, start, start + size))
+            counter = [0]
+            key = lambda x: x.getField(sort_on).get(x)
+            if reverse:
+                top = heapq.nlargest(start + size,
+                                     _counting(visible, counter), key)
+            else:
+                top = heapq.nsmallest(start + size,
+                                      _counting(visible, counter), key)
+            state['total'] = counter[0]
+            return top[start:]
+
+        def total():
+            if 'total' not in state:
+                state['total'] = len(list(_visible(objs_func())))
+            return state['total']
+
+        return LazyRefBatch(page, total)
+
+    def _orderedTargets(self, obj, relationship, reverse, back=False):
+        if back:
+            refs = obj.getBackReferenceImpl(relationship)
+        else:
+            refs = obj.getReferenceImpl(relationship)
+        refs.sort(key=_orderKey)
+        if reverse:
+            refs.reverse()
+        # the objects are only woken as the page is filled
+        if back:
+            return lambda: (ref.getSourceObject() for ref in refs)
+        return lambda: (ref.getTargetObject() for ref in refs)
+
+    def _lazyRefs(self, obj, relationship, reverse, back=False):
+        """Same objects as getRefs/getBRefs, woken one at a time
+        """
+        if back:
+            refs = obj.getBackReferenceImpl(relationship)
+        else:
+            refs = obj.getReferenceImpl(relationship)
+        if reverse:
+            refs.reverse()
+        if back:
+            return lambda: (ref.getSourceObject() for ref in refs)
+        return lambda: (ref.getTargetObject() for ref in refs)
+
+    def getFilteredRefsBatch(self, obj, relationship, sort_on=None,
+                             reverse=False, start=0, size=10):
+        """see IReferenceUtils for documentation
+        """
+        if sort_on is None:
+            targets = self._lazyRefs(obj, relationship, reverse)
+            return self._batch(targets, None, False, start, size)
+        refs = _asList(obj.getRefs(relationship))
+        return self._batch(lambda: iter(refs), sort_on, reverse, start, size)
+
+    def getFilteredBRefsBatch(self, obj, relationship, sort_on=None,
+                              reverse=False, start=0, size=10):
+        """see IReferenceUtils for documentation
+        """
+        if sort_on is None:
+            sources = self._lazyRefs(obj, relationship, reverse, back=True)
+            return self._batch(sources, None, False, start, size)
+        refs = _asList(obj.getBRefs(relationship))
+        return self._batch(lambda: iter(refs), sort_on, reverse, start, size)
+
+    def getFilteredOrderedRefsBatch(self, obj, relationship, reverse=False,
+                                    start=0, size=10):
+        """see IReferenceUtils for documentation
+        """
+        targets = self._orderedTargets(obj, relationship, reverse)
+        return self._batch(targets, None, False, start, size)
+
+    def getFilteredOrderedBRefsBatch(self, obj, relationship, reverse=False,
+                                     start=0, size=10):
+        """see IReferenceUtils for documentation
+        """
+        sources = self._orderedTargets(obj, relationship, reverse, back=True)
+        return self._batch(sources, None, False, start, size)
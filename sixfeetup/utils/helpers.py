@@ -1,24 +1,351 @@
+import csv
+import fnmatch
 import logging
 import os
+import re
+import time
+from datetime import datetime
+from hashlib import md5
+from urllib import quote
+try:
+    import json
+except ImportError:
+    import simplejson as json
 try:
         # Plone < 4.3
-            from zope.app.component.hooks import getSite
+            from zope.app.component.hooks import getSite, setSite
 except ImportError:
         # Plone >= 4.3
-            from zope.component.hooks import getSite # NOQA
+            from zope.component.hooks import getSite, setSite # NOQA
+import transaction
+from BTrees.IIBTree import IITreeSet
 from DateTime import DateTime
+from persistent.mapping import PersistentMapping
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryMultiAdapter
 from Testing.makerequest import makerequest
 
+from Acquisition import aq_base
 from Acquisition import aq_parent
 from Products.CMFCore.utils import getToolByName
 from Products.GenericSetup.upgrade import _upgrade_registry
 from Products.GenericSetup.registry import _profile_registry
+from Products.CMFPlone.interfaces import IPloneSiteRoot
 from Products.CMFPlone.utils import base_hasattr
+from Products.CMFPlone.utils import safe_callable
 from Products.CMFCore.WorkflowCore import WorkflowException
+from sixfeetup.utils.instrumentation import countObjects
+from sixfeetup.utils.instrumentation import instrumented
+from sixfeetup.utils.instrumentation import profiled
+try:
+    from plone.indexer.interfaces import IIndexableObject
+except ImportError:
+    IIndexableObject = None
+try:
+    from plone.locking.interfaces import ILockable
+except ImportError:
+    ILockable = None
 
 
 logger = logging.getLogger(__name__)
 
+CHECKPOINT_KEY = 'sixfeetup.utils.checkpoints'
+
+# where togglePASPlugins keeps what it disabled on a site
+DISABLED_PLUGINS_KEY = 'sixfeetup.utils.disabled_plugins'
+
+LDAP_META_TYPES = ('Plone Active Directory plugin',
+                   'Plone LDAP plugin',
+                   'LDAP Multi Plugin',
+                   'ActiveDirectory Multi Plugin')
+
+LDAP_INTERFACES = ("IAuthenticationPlugin",
+                   "ICredentialsResetPlugin",
+                   "IGroupEnumerationPlugin",
+                   "IGroupIntrospection",
+                   "IGroupManagement",
+                   "IGroupsPlugin",
+                   "IPropertiesPlugin",
+                   "IRoleEnumerationPlugin",
+                   "IRolesPlugin",
+                   "IUserEnumerationPlugin")
+
+# where refreshAssetRegistry keeps the fingerprint of a registry
+FINGERPRINT_ATTR = '_sixfeetup_fingerprint'
+
+# naive ISO dates that can be parsed without DateTime
+ISO_DATE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?$')
+
+# indexes whose stored entries can be compared with the indexed value
+COMPARABLE_INDEXES = ('FieldIndex', 'KeywordIndex', 'BooleanIndex',
+                      'UUIDIndex')
+
+#####################################################
+# Batching helpers shared by the bulk operations below
+
+
+def _commitBatch(portal, savepoint=False, note=None):
+    """Commit (or savepoint) the work done so far and shrink the pickle
+    cache so that bulk operations don't keep every object in memory
+    """
+    if savepoint:
+        transaction.savepoint(optimistic=True)
+    else:
+        txn = transaction.get()
+        if note is not None:
+            txn.note(note)
+        txn.commit()
+    jar = getattr(portal, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()
+
+
+def _logProgress(name, count, total, started):
+    """Log how far along a bulk operation is, its throughput and ETA
+    """
+    elapsed = time.time() - started
+    rate = elapsed and count / elapsed or 0.0
+    eta = rate and (total - count) / rate or 0.0
+    logger.info('%s: %d/%d objects in %.1fs (%.1f objects/sec, ETA %.0fs)',
+                name, count, total, elapsed, rate, eta)
+
+
+def _pathQuery(portal, path=None, recursive=True):
+    """Build the catalog path query used by the bulk operations
+    """
+    query = {}
+    if path is None:
+        query['path'] = "/%s" % portal.id
+    else:
+        query['path'] = path
+    if not recursive:
+        query['path'] = {'query': query['path'], 'depth': 0}
+    return query
+
+
+def walkObjects(query=None, path=None, recursive=True, unrestricted=False,
+                brains_only=False, batch_size=500, start_after=None,
+                portal=None):
+    """Lazily yield the objects matching a catalog query in physical path
+    order
+
+    This is what the bulk helpers use to walk the site. The objects are
+    woken one at a time and the ZODB cache is shrunk every batch_size
+    objects, so memory use depends on the batch size rather than on the
+    size of the site.
+
+    query is merged into the path query built from path and recursive.
+    Pass unrestricted=True to use unrestrictedSearchResults and skip the
+    security checks when getting the objects, brains_only=True to get the
+    catalog brains without waking the objects and start_after to skip
+    every path up to and including the given one.
+
+    The catalog is queried right away, len() of the result is the number
+    of objects left to walk, so callers don't need to run the query twice
+    to report progress.
+    """
+    if portal is None:
+        portal = getSite()
+    pc = getToolByName(portal, 'portal_catalog')
+    full_query = _pathQuery(portal, path, recursive)
+    if query:
+        full_query.update(query)
+    if unrestricted:
+        res = pc.unrestrictedSearchResults(full_query)
+    else:
+        res = pc.searchResults(full_query)
+    start_key = None
+    if start_after is not None:
+        start_key = _pathKey(start_after)
+    # only the record ids of the results are kept, the paths are walked
+    # in order from the catalog when iterating
+    rids = IITreeSet()
+    for brain in res:
+        if start_key is None or _pathKey(brain.getPath()) > start_key:
+            rids.insert(brain.getRID())
+    del res
+    if path is None:
+        path = "/%s" % portal.id
+    return _ObjectWalk(portal, pc._catalog, path, recursive, rids,
+                       start_key, unrestricted, brains_only, batch_size)
+
+
+def _pathKey(path):
+    """Sort key putting paths in physical path order
+
+    Comparing the strings would put /plone/a-b between /plone/a and
+    /plone/a/c.
+    """
+    return path.split('/')
+
+
+def _childIds(uids, path):
+    """The ids of the objects directly below path that are cataloged or
+    have cataloged objects below them
+
+    The catalog keeps its paths in a BTree, every id is found with a few
+    lookups in it, skipping whatever is below it.
+    """
+    prefix = path + '/'
+    # '0' is the character following '/'
+    end = path + '0'
+    ids = set()
+    cursor = prefix
+    while True:
+        try:
+            key = uids.minKey(cursor)
+        except ValueError:
+            break
+        if key >= end:
+            break
+        child_id = key[len(prefix):].split('/', 1)[0]
+        ids.add(child_id)
+        child = prefix + child_id
+        if key == child:
+            cursor = child + '\0'
+        else:
+            cursor = child + '0'
+    return ids
+
+
+def _walkPaths(uids, path, recursive=True, start_key=None):
+    """Yield the (path, rid) of the objects cataloged at and below path in
+    physical path order, skipping the paths up to start_key
+    """
+    rid = uids.get(path)
+    if rid is not None and (start_key is None or _pathKey(path) > start_key):
+        yield path, rid
+    if not recursive:
+        return
+    for child_id in sorted(_childIds(uids, path)):
+        child = path + '/' + child_id
+        if start_key is not None:
+            key = _pathKey(child)
+            if key < start_key and key != start_key[:len(key)]:
+                # walked already, and everything below it
+                continue
+        for entry in _walkPaths(uids, child, recursive, start_key):
+            yield entry
+
+
+class _ObjectWalk(object):
+    """The objects found by walkObjects
+    """
+
+    def __init__(self, portal, catalog, path, recursive, rids,
+                 start_key=None, unrestricted=False, brains_only=False,
+                 batch_size=500):
+        self.portal = portal
+        self.catalog = catalog
+        self.path = path
+        self.recursive = recursive
+        self.rids = rids
+        self.start_key = start_key
+        self.unrestricted = unrestricted
+        self.brains_only = brains_only
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.rids)
+
+    def __iter__(self):
+        catalog = self.catalog
+        rids = self.rids
+        batch_size = self.batch_size
+        jar = self.portal._p_jar
+        count = 0
+        for obj_path, rid in _walkPaths(catalog.uids, self.path,
+                                        self.recursive, self.start_key):
+            if rid not in rids:
+                continue
+            try:
+                brain = catalog[rid]
+            except KeyError:
+                # uncataloged since the query was run
+                continue
+            countObjects()
+            if self.brains_only:
+                yield brain
+            elif self.unrestricted:
+                yield brain._unrestrictedGetObject()
+            else:
+                yield brain.getObject()
+            count += 1
+            if batch_size and not count % batch_size and jar is not None:
+                jar.cacheGC()
+
+
+def _doTransition(wftool, obj, transition, comment):
+    """Run the transition in every workflow of obj that supports it
+
+    Returns the number of transitions that were done.
+    """
+    num_transitions = 0
+    for wf in wftool.getWorkflowsFor(obj):
+        if wf.isActionSupported(obj, transition):
+            try:
+                wf.doActionFor(obj, transition, comment=comment)
+                num_transitions += 1
+            except WorkflowException:
+                logger.warning("\ncouldn't %s %s\n**********\n",
+                               transition, obj.Title())
+        else:
+            logger.debug("\nTransition not supported, %s: %s\n**********\n",
+                         wf.id, transition)
+    if not num_transitions:
+        logger.warning("\nNo transitions found, %s: %s\n**********\n",
+                       transition, obj.Title())
+    return num_transitions
+
+
+def _checkpoints(portal, create=False):
+    annotations = IAnnotations(portal)
+    checkpoints = annotations.get(CHECKPOINT_KEY)
+    if checkpoints is None and create:
+        checkpoints = annotations[CHECKPOINT_KEY] = PersistentMapping()
+    return checkpoints
+
+
+def getCheckpoint(name, portal=None):
+    """Return the checkpoint stored for a resumable bulk operation
+
+    The checkpoint is a dictionary with the 'path' and 'rid' of the last
+    processed object and the 'count' of objects processed so far, or None
+    if there is no checkpoint.
+    """
+    if portal is None:
+        portal = getSite()
+    checkpoints = _checkpoints(portal)
+    if checkpoints is None:
+        return None
+    return checkpoints.get(name)
+
+
+def setCheckpoint(name, path, rid, count, portal=None):
+    """Store the checkpoint for a resumable bulk operation
+
+    It is committed along with the batch it belongs to.
+    """
+    if portal is None:
+        portal = getSite()
+    _checkpoints(portal, create=True)[name] = {
+        'path': path,
+        'rid': rid,
+        'count': count,
+    }
+
+
+def clearCheckpoint(name, portal=None):
+    """Forget the checkpoint so the next run starts from scratch
+    """
+    if portal is None:
+        portal = getSite()
+    checkpoints = _checkpoints(portal)
+    if checkpoints is not None and name in checkpoints:
+        del checkpoints[name]
+
+
 #####################################################
 # Random bits and pieces of code that could be useful
 
@@ -30,27 +357,102 @@ def dateForProcessForm(field, field_date, form_dict=None):
     If form_dict is not passed in a dictionary will be passed back. Otherwise
     the form dictionary will be updated.
     """
-    if not isinstance(field_date, DateTime):
-        field_date = DateTime(field_date)
     will_return = False
     if form_dict is None:
         will_return = True
         form_dict = {}
-    form_dict[field] = field_date.ISO()
-    form_dict['%s_year' % field] = field_date.year()
-    form_dict['%s_month' % field] = field_date.month()
-    form_dict['%s_day' % field] = field_date.day()
-    form_dict['%s_hour' % field] = field_date.hour()
-    form_dict['%s_minute' % field] = field_date.minute()
+    _fillDate(form_dict, field, _dateParts(field_date))
     if not will_return:
         return
     return form_dict
 
 
+def datesForProcessForm(dates, form_dict=None, cache=None):
+    """Same as dateForProcessForm for many (field, date) pairs at once
+
+    dates is a list of (field, date) pairs or a dictionary. The form
+    dictionary is returned. Pass the same cache dictionary to several
+    calls to only parse repeated dates once.
+    """
+    if form_dict is None:
+        form_dict = {}
+    if cache is None:
+        cache = {}
+    if isinstance(dates, dict):
+        dates = dates.items()
+    for field, field_date in dates:
+        _fillDate(form_dict, field, _dateParts(field_date, cache))
+    return form_dict
+
+
+def fillDatesForProcessForm(form_dicts, fields):
+    """Convert the dates of fields in every form dictionary in one pass
+
+    Each form dictionary holding a value for one of the fields gets the
+    keys processForm expects for it, like dateForProcessForm. Repeated
+    dates are only parsed once. Returns form_dicts.
+    """
+    cache = {}
+    for form_dict in form_dicts:
+        for field in fields:
+            field_date = form_dict.get(field)
+            if field_date:
+                _fillDate(form_dict, field, _dateParts(field_date, cache))
+    return form_dicts
+
+
+def _fillDate(form_dict, field, parts):
+    form_dict[field] = parts[0]
+    form_dict['%s_year' % field] = parts[1]
+    form_dict['%s_month' % field] = parts[2]
+    form_dict['%s_day' % field] = parts[3]
+    form_dict['%s_hour' % field] = parts[4]
+    form_dict['%s_minute' % field] = parts[5]
+
+
+def _dateParts(field_date, cache=None):
+    """Return the ISO string, year, month, day, hour and minute of a date
+
+    Naive ISO strings and datetimes are handled with the standard library,
+    anything else goes through DateTime.
+    """
+    key = field_date
+    cacheable = cache is not None and isinstance(key, basestring)
+    if cacheable and key in cache:
+        return cache[key]
+    parts = None
+    values = None
+    if isinstance(field_date, basestring):
+        match = ISO_DATE.match(field_date.strip())
+        if match is not None:
+            values = [int(value or 0) for value in match.groups()]
+    elif isinstance(field_date, datetime) and field_date.tzinfo is None:
+        values = [field_date.year, field_date.month, field_date.day,
+                  field_date.hour, field_date.minute, field_date.second]
+    if values is not None:
+        try:
+            # validate the date
+            datetime(*values)
+        except ValueError:
+            pass
+        else:
+            parts = ('%.4d-%.2d-%.2d %.2d:%.2d:%.2d' % tuple(values),
+                     ) + tuple(values[:5])
+    if parts is None:
+        if not isinstance(field_date, DateTime):
+            field_date = DateTime(field_date)
+        parts = (field_date.ISO(), field_date.year(), field_date.month(),
+                 field_date.day(), field_date.hour(), field_date.minute())
+    if cacheable:
+        cache[key] = parts
+    return parts
+
+
 ######################################################
 # Helpers for GenericSetup upgrades and setup handlers
 
 
+@instrumented
 def updateCatalog(context=None):
     """Update the catalog
     """
@@ -61,29 +463,254 @@ def updateCatalog(context=None):
     logger.info('****** updateCatalog END ******')
 
 
-def clearAndRebuildCatalog(context=None):
+def _indexableObject(obj, catalog):
+    """Return the object the way the catalog sees it when indexing
+    """
+    if IIndexableObject is None:
+        return obj
+    wrapper = queryMultiAdapter((obj, catalog), IIndexableObject)
+    if wrapper is None:
+        return obj
+    return wrapper
+
+
+def _attributeValue(wrapper, name):
+    value = getattr(wrapper, name, None)
+    if safe_callable(value):
+        try:
+            value = value()
+        except (AttributeError, TypeError):
+            value = None
+    return value
+
+
+def _sameValue(old, new):
+    if isinstance(old, (list, tuple)) or isinstance(new, (list, tuple)):
+        try:
+            return set(old or ()) == set(new or ())
+        except TypeError:
+            return False
+    return old == new
+
+
+def _indexIsCurrent(catalog, name, rid, wrapper):
+    """Check if the entry stored in the index matches the object
+
+    Indexes that store a transformed value (dates, text) can't be compared
+    and are always considered out of date.
+    """
+    index = catalog.getIndex(name)
+    if index.meta_type not in COMPARABLE_INDEXES:
+        return False
+    try:
+        source = index.getIndexSourceNames()[0]
+    except (AttributeError, IndexError):
+        source = name
+    marker = []
+    old = index.getEntryForObject(rid, marker)
+    if old is marker:
+        return False
+    return _sameValue(old, _attributeValue(wrapper, source))
+
+
+@instrumented
+def reindexIndexes(context=None, indexes=(), metadata=(), path=None,
+                   portal_type=None, batch_size=1000):
+    """Reindex only the given indexes and metadata columns
+
+    This is what an upgrade adding an index or column needs, instead of
+    updateCatalog reindexing every index of every object. Pass in a
+    PhysicalPath and/or portal_type to restrict the objects.
+
+    Objects whose stored values are unchanged are skipped, the rest is
+    reindexed with only the out of date indexes. The work is committed
+    every batch_size objects. Returns a dictionary with the number of
+    objects 'touched' and 'skipped'.
+    """
+    logger.info('****** reindexIndexes BEGIN ******')
+    portal = getSite()
+    pc = getToolByName(portal, 'portal_catalog')
+    catalog = pc._catalog
+    indexes = list(indexes)
+    metadata = list(metadata)
+    for name in indexes[:]:
+        if name not in catalog.indexes:
+            logger.warning('reindexIndexes: no index named %s', name)
+            indexes.remove(name)
+    for name in metadata[:]:
+        if name not in catalog.schema:
+            logger.warning('reindexIndexes: no metadata column %s', name)
+            metadata.remove(name)
+    query = {}
+    if portal_type is not None:
+        query['portal_type'] = portal_type
+    started = time.time()
+    touched = skipped = count = 0
+    if indexes or metadata:
+        brains = walkObjects(query, path, unrestricted=True,
+                             brains_only=True, portal=portal)
+        total = len(brains)
+        for brain in brains:
+            count += 1
+            obj = brain._unrestrictedGetObject()
+            rid = brain.getRID()
+            wrapper = _indexableObject(obj, pc)
+            changed = [name for name in indexes
+                       if not _indexIsCurrent(catalog, name, rid, wrapper)]
+            record = catalog.data[rid]
+            update_metadata = False
+            for name in metadata:
+                old = record[catalog.schema[name]]
+                if not _sameValue(old, _attributeValue(wrapper, name)):
+                    update_metadata = True
+                    break
+            if changed:
+                pc.catalog_object(obj, brain.getPath(), idxs=changed,
+                                  update_metadata=update_metadata)
+                touched += 1
+            elif update_metadata:
+                catalog.updateMetadata(wrapper, brain.getPath(), rid)
+                touched += 1
+            else:
+                skipped += 1
+            if batch_size and not count % batch_size:
+                _commitBatch(portal, note='reindexIndexes: %d objects' % count)
+                _logProgress('reindexIndexes', count, total, started)
+        _commitBatch(portal, note='reindexIndexes: %d objects' % count)
+    logger.info('reindexIndexes: %d objects touched, %d skipped in %.1fs',
+                touched, skipped, time.time() - started)
+    logger.info('****** reindexIndexes END ******')
+    return {'touched': touched, 'skipped': skipped}
+
+
+@instrumented
+def clearAndRebuildCatalog(context=None, processes=None, **kw):
     """Clear and rebuild the catalog
+
+    Pass in the number of processes to split the content tree into shards
+    that are indexed in parallel, each with its own ZODB connection. This
+    needs a storage that can be shared between processes (ZEO,
+    RelStorage), see sixfeetup.utils.parallel.parallelRebuildCatalog for
+    the other keyword arguments.
     """
     logger.info('****** clearAndRebuildCatalog BEGIN ******')
+    if processes:
+        from sixfeetup.utils.parallel import parallelRebuildCatalog
+        parallelRebuildCatalog(processes=processes, **kw)
+        logger.info('****** clearAndRebuildCatalog END ******')
+        return
     portal = getSite()
     pc = getToolByName(portal, 'portal_catalog')
     pc.clearFindAndRebuild()
     logger.info('****** clearAndRebuildCatalog END ******')
 
 
-def updateSecurity(context=None):
-    """Run the update security on the workflow tool"""
+@instrumented
+def updateSecurity(context=None, path=None, workflow_ids=None,
+                   batch_size=None):
+    """Run the update security on the workflow tool
+
+    Pass in a PhysicalPath and/or a list of workflow ids to only update
+    the objects below that path and governed by those workflows. Only the
+    security index of the changed objects is reindexed, the work is
+    committed every batch_size objects and progress is logged.
+    """
     logger.info('****** updateSecurity BEGIN ******')
     portal = getSite()
     wtool = getToolByName(portal, 'portal_workflow')
-    wtool.updateRoleMappings()
+    if path is None and workflow_ids is None and batch_size is None:
+        wtool.updateRoleMappings()
+        logger.info('****** updateSecurity END ******')
+        return
+    query = {}
+    if workflow_ids is not None:
+        workflow_ids = list(workflow_ids)
+        placeful = getToolByName(portal, 'portal_placeful_workflow', None)
+        if placeful is None:
+            # without placeful policies the types tell the workflows
+            ttool = getToolByName(portal, 'portal_types')
+            query['portal_type'] = [
+                type_id for type_id in ttool.listContentTypes()
+                if [wf_id for wf_id in wtool.getChainForPortalType(type_id)
+                    if wf_id in workflow_ids]]
+            if not query['portal_type']:
+                logger.info('updateSecurity: no types use %s',
+                            ', '.join(workflow_ids))
+                logger.info('****** updateSecurity END ******')
+                return
+    if path is None:
+        path = "/%s" % portal.id
+    _updateSecurityForPaths(portal, [path], workflow_ids=workflow_ids,
+                            query=query, batch_size=batch_size)
     logger.info('****** updateSecurity END ******')
 
+
+def _updateRoleMappingsFor(wtool, obj, workflow_ids=None):
+    """Update the role mappings of one object like
+    WorkflowTool.updateRoleMappings does, but without recursing
+
+    Returns True if the mappings changed.
+    """
+    changed = False
+    for wf in wtool.getWorkflowsFor(obj):
+        if workflow_ids is not None and wf.getId() not in workflow_ids:
+            continue
+        if wf.updateRoleMappingsFor(obj):
+            changed = True
+    if changed and base_hasattr(obj, 'reindexObject'):
+        obj.reindexObject(idxs=['allowedRolesAndUsers'])
+    return changed
+
+
+def _outermostPaths(paths):
+    """Drop the paths that are inside one of the other paths
+    """
+    roots = []
+    # sorting in physical path order keeps every subtree together
+    for path in sorted(set(paths), key=_pathKey):
+        if roots and path.startswith(roots[-1] + '/'):
+            continue
+        roots.append(path)
+    return roots
+
+
+def _updateSecurityForPaths(portal, paths, recursive=True, workflow_ids=None,
+                            query=None, batch_size=None,
+                            name='updateSecurity'):
+    """Update the role mappings of the objects at (and below) paths
+
+    Paths inside other paths are only handled once. Returns a dictionary
+    with the number of objects 'checked' and 'changed'.
+    """
+    wtool = getToolByName(portal, 'portal_workflow')
+    if recursive:
+        roots = _outermostPaths(paths)
+    else:
+        roots = sorted(set(paths))
+    started = time.time()
+    checked = changed = 0
+    for root in roots:
+        for obj in walkObjects(query, root, recursive, unrestricted=True,
+                               portal=portal):
+            checked += 1
+            if _updateRoleMappingsFor(wtool, obj, workflow_ids):
+                changed += 1
+            if batch_size and not checked % batch_size:
+                _commitBatch(portal, note='%s: %d objects' % (name, checked))
+                logger.info('%s: %d objects checked, %d changed in %.1fs',
+                            name, checked, changed, time.time() - started)
+    if batch_size:
+        _commitBatch(portal, note='%s: %d objects' % (name, checked))
+    logger.info('%s: %d objects checked, %d changed in %.1fs', name, checked,
+                changed, time.time() - started)
+    return {'checked': checked, 'changed': changed}
+
 #########################################################
 # GenericSetup forces a redirect on some of these methods, we are
 # basically rewriting them here without that.
 
 
+@instrumented
 def deleteImportSteps(ids):
     """Remove a list of import step IDs
     """
@@ -97,6 +724,7 @@ def deleteImportSteps(ids):
     setup_tool._p_changed = True
 
 
+@instrumented
 def deleteExportSteps(ids):
     """Remove a list of export step IDs
     """
@@ -110,7 +738,42 @@ def deleteExportSteps(ids):
     setup_tool._p_changed = True
 
 
-def runUpgradeSteps(profile_id):
+def _versionString(version):
+    if version is None:
+        return '*'
+    if isinstance(version, basestring):
+        return version
+    return '.'.join(version)
+
+
+def getUpgradePlan(profile_id):
+    """Return the pending upgrade steps for the given profile_id
+
+    The plan is a list of dictionaries with the 'id', 'title', 'source'
+    and 'dest' of each step, in the order they will be run.
+    """
+    portal = getSite()
+    setup_tool = getToolByName(portal, 'portal_setup')
+    plan = []
+    for step in setup_tool.listUpgrades(profile_id):
+        if not isinstance(step, list):
+            step = [step]
+        # a list is a group of steps
+        for info in step:
+            upgrade = info['step']
+            plan.append({
+                'id': upgrade.id,
+                'title': upgrade.title,
+                'source': _versionString(upgrade.source),
+                'dest': _versionString(upgrade.dest),
+            })
+    return plan
+
+
+@instrumented
+@profiled
+def runUpgradeSteps(profile_id, dry_run=False, commit=False,
+                    report_file=None):
     """run the upgrade steps for the given profile_id in the form of:
 
     profile-<package_name>:<profile_name>
@@ -122,81 +785,201 @@ def runUpgradeSteps(profile_id):
     Basically this is the code from GS.tool.manage_doUpgrades() in step
     form.  Had to extract the code because it was doing a redirect back to the
     upgrades form in the GS tool.
+
+    The plan of steps to run is logged first, pass dry_run=True to stop
+    there. Each step is timed, and with commit=True it is committed on its
+    own so a long migration isn't one giant transaction. The profile
+    version is only set to the destination of the last step that
+    completed, or to the version of the profile when all of them did.
+
+    Returns a report with the plan and the timing of each step, which is
+    also written as JSON to report_file if given.
     """
     portal = getSite()
     setup_tool = getToolByName(portal, 'portal_setup')
     logger.info('****** runUpgradeSteps BEGIN ******')
-    upgrade_steps = setup_tool.listUpgrades(profile_id)
-    steps_to_run = []
-    for step in upgrade_steps:
-        if isinstance(step, list):
-            # this is a group of steps
-            for new_step in step:
-                steps_to_run.append(new_step['step'].id)
-        else:
-            steps_to_run.append(step['step'].id)
-
-    #################
-    # from GS tool...
-    ##################
-    for step_id in steps_to_run:
-        step = _upgrade_registry.getUpgradeStep(profile_id, step_id)
-        if step is not None:
-            step.doStep(setup_tool)
-            msg = "Ran upgrade step %s for profile %s" % (step.title,
-                                                          profile_id)
+    plan = getUpgradePlan(profile_id)
+    for entry in plan:
+        logger.info('Upgrade plan for %s: %s (%s -> %s) %s', profile_id,
+                    entry['id'], entry['source'], entry['dest'],
+                    entry['title'])
+    report = {
+        'profile_id': profile_id,
+        'dry_run': dry_run,
+        'steps': plan,
+    }
+    if dry_run:
+        _writeReport(report, report_file)
+        logger.info('****** runUpgradeSteps END ******')
+        return report
+
+    started = time.time()
+    last_dest = None
+    completed = True
+    try:
+        #################
+        # from GS tool...
+        ##################
+        for entry in plan:
+            step = _upgrade_registry.getUpgradeStep(profile_id, entry['id'])
+            if step is None:
+                entry['status'] = 'missing'
+                continue
+            entry['status'] = 'failed'
+            step_started = time.time()
+            try:
+                step.doStep(setup_tool)
+            finally:
+                entry['seconds'] = time.time() - step_started
+            entry['status'] = 'done'
+            # steps for any version don't tell how far the profile is
+            if entry['dest'] != '*':
+                last_dest = entry['dest']
+            msg = "Ran upgrade step %s for profile %s in %.1fs" % (
+                step.title, profile_id, entry['seconds'])
             logger.info(msg)
-
-    # XXX should be a bit smarter about deciding when to up the
-    #     profile version
-    profile_info = _profile_registry.getProfileInfo(profile_id)
-    version = profile_info.get('version', None)
-    if version is not None:
-        setup_tool.setLastVersionForProfile(profile_id, version)
-
-    logger.info('****** runUpgradeSteps END ******')
+            if commit:
+                if last_dest is not None:
+                    setup_tool.setLastVersionForProfile(profile_id,
+                                                        last_dest)
+                txn = transaction.get()
+                txn.note('Upgrade step %s for profile %s' % (step.title,
+                                                             profile_id))
+                txn.commit()
+    except:
+        completed = False
+        if commit:
+            transaction.abort()
+        raise
+    finally:
+        report['seconds'] = time.time() - started
+        if completed:
+            profile_info = _profile_registry.getProfileInfo(profile_id)
+            version = profile_info.get('version', None)
+        else:
+            version = last_dest
+        if version is not None and version != '*':
+            setup_tool.setLastVersionForProfile(profile_id, version)
+            if commit:
+                transaction.commit()
+        report['version'] = version
+        _writeReport(report, report_file)
+        logger.info('****** runUpgradeSteps END ******')
+    return report
+
+
+def _writeReport(report, report_file=None):
+    """Log a report as JSON and write it to report_file if given
+    """
+    data = json.dumps(report, sort_keys=True)
+    logger.info('Report: %s', data)
+    if report_file is not None:
+        f = open(report_file, 'w')
+        try:
+            f.write(data)
+        finally:
+            f.close()
 
 
+@instrumented
 def publishEverything(context=None, path=None, transition='publish',
-                      recursive=True):
+                      recursive=True, review_state=None, batch_size=None,
+                      savepoint=False):
     """Publishes all content that has the given transition
 
     Pass in a PhysicalPath to publish a specific section
+
+    Pass in a review_state (or list of states) to only wake the objects
+    that can actually be transitioned, e.g. review_state='private'.
+
+    If batch_size is given the work is committed every batch_size objects
+    and the ZODB cache is shrunk in between batches, so huge sites are not
+    handled in a single transaction. Pass savepoint=True to use savepoints
+    instead of commits and leave committing to the caller.
     """
     portal = getSite()
-    pc = getToolByName(portal, 'portal_catalog')
     wftool = getToolByName(portal, 'portal_workflow')
     query = {}
-    if path is None:
-        query['path'] = "/%s" % portal.id
-    else:
-        query['path'] = path
-    if not recursive:
-        query['path'] = {'query': query['path'], 'depth': 0}
-    res = pc(query)
-    for result in res:
-        num_transitions = 0
-        obj = result.getObject()
-        for wf in wftool.getWorkflowsFor(obj):
-            if wf.isActionSupported(obj, transition):
-                try:
-                    wf.doActionFor(
-                        obj,
-                        transition,
-                        comment='Content published automatically'
-                    )
-                    num_transitions += 1
-                except WorkflowException:
-                    logger.warning("\ncouldn't %s %s\n**********\n",
-                                   transition, obj.Title())
-            else:
-                logger.debug("\nTransition not supported, %s: %s\n**********\n",
-                             wf.id, transition)
-        if not num_transitions:
-            logger.warning("\nNo transitions found, %s: %s\n**********\n",
-                           transition, obj.Title())
-
-
+    if review_state is not None:
+        query['review_state'] = review_state
+    objs = walkObjects(query, path, recursive, portal=portal)
+    total = len(objs)
+    started = time.time()
+    count = 0
+    for obj in objs:
+        _doTransition(wftool, obj, transition,
+                      'Content published automatically')
+        count += 1
+        if batch_size and not count % batch_size:
+            _commitBatch(portal, savepoint,
+                         note='publishEverything: %d objects' % count)
+            _logProgress('publishEverything', count, total, started)
+    if batch_size:
+        _commitBatch(portal, savepoint,
+                     note='publishEverything: %d objects' % count)
+        _logProgress('publishEverything', count, total, started)
+
+
+@instrumented
+def bulkTransition(context=None, path=None, transition='publish',
+                   recursive=True, review_state=None, batch_size=500,
+                   checkpoint='bulkTransition', log_interval=60,
+                   comment='Content transitioned automatically'):
+    """Resumable version of publishEverything for huge sites
+
+    Objects are processed in physical path order and the work is
+    committed every batch_size objects together with a checkpoint holding
+    the last processed path. If the run is killed or crashes, running it
+    again with the same checkpoint name picks up where it stopped instead
+    of walking the whole catalog again. The checkpoint is removed when the
+    run completes, use clearCheckpoint to start over by hand.
+
+    Progress, elapsed time and ETA are logged every log_interval seconds.
+    """
+    portal = getSite()
+    wftool = getToolByName(portal, 'portal_workflow')
+    query = {}
+    if review_state is not None:
+        query['review_state'] = review_state
+    done = 0
+    start_after = None
+    state = getCheckpoint(checkpoint, portal)
+    if state is not None:
+        start_after = state['path']
+        done = state['count']
+        logger.info('bulkTransition: resuming %s after %s (%d done)',
+                    checkpoint, start_after, done)
+    brains = walkObjects(query, path, recursive, brains_only=True,
+                         start_after=start_after, portal=portal)
+    # what is left to do, whether or not the query matches the objects
+    # that were already transitioned
+    total = len(brains)
+    started = last_log = time.time()
+    count = 0
+    for brain in brains:
+        obj_path = brain.getPath()
+        rid = brain.getRID()
+        obj = portal.unrestrictedTraverse(obj_path, None)
+        if obj is None:
+            logger.warning('bulkTransition: could not find %s', obj_path)
+        else:
+            _doTransition(wftool, obj, transition, comment)
+        count += 1
+        if batch_size and not count % batch_size:
+            setCheckpoint(checkpoint, obj_path, rid, done + count, portal)
+            _commitBatch(portal, note='bulkTransition: %s' % obj_path)
+        if time.time() - last_log >= log_interval:
+            _logProgress('bulkTransition', count, total, started)
+            last_log = time.time()
+    _logProgress('bulkTransition', count, total, started)
+    clearCheckpoint(checkpoint, portal)
+    transaction.commit()
+    logger.info('bulkTransition: %s finished, %d objects', checkpoint,
+                done + count)
+
+
+@instrumented
+@profiled
 def runMigrationProfile(profile_id):
     """Run a migration profile as an upgrade step
 
@@ -213,30 +996,153 @@ def runMigrationProfile(profile_id):
     setup_tool.runAllImportStepsFromProfile(profile_id)
 
 
-def clearLocks(context=None, path=None, recursive=True):
+@instrumented
+def clearLocks(context=None, path=None, recursive=True, lock_index=None,
+               batch_size=None):
     """Little util method to clear locks on a given path
 
     Pass in a PhysicalPath to restrict to a specific section
+
+    The WebDAV lock information is read straight from each object instead
+    of traversing to the lock views. If the catalog has an index telling
+    which objects are locked, pass its name as lock_index so that only the
+    locked objects are woken. Pass in a batch_size to commit every
+    batch_size unlocked objects.
+
+    Returns the number of objects that were unlocked.
     """
     portal = getSite()
     pc = getToolByName(portal, 'portal_catalog')
     query = {}
-    if path is None:
-        query['path'] = "/%s" % portal.id
-    else:
-        query['path'] = path
-    if not recursive:
-        query['path'] = {'query': query['path'], 'depth': 0}
-    res = pc(query)
-    for item in res:
-        obj_path = '/'.join(item.getObject().getPhysicalPath())
-        lock_info = '%s/@@plone_lock_info' % obj_path
-        locked = portal.restrictedTraverse(lock_info).is_locked()
-        if locked:
-            lock_ops = '%s/@@plone_lock_operations' % obj_path
-            portal.restrictedTraverse(lock_ops).force_unlock(redirect=False)
+    if lock_index is not None:
+        if lock_index in pc.indexes():
+            query[lock_index] = True
+        else:
+            logger.warning('clearLocks: no index named %s, checking every '
+                           'object', lock_index)
+    started = time.time()
+    cleared = 0
+    for obj in walkObjects(query, path, recursive, portal=portal):
+        if not base_hasattr(obj, 'wl_isLocked') or not obj.wl_isLocked():
+            continue
+        lockable = ILockable is not None and ILockable(obj, None) or None
+        if lockable is not None:
+            lockable.clear_locks()
+        else:
+            obj.wl_clearLocks()
+        cleared += 1
+        if batch_size and not cleared % batch_size:
+            _commitBatch(portal, note='clearLocks: %d locks' % cleared)
+    if batch_size:
+        _commitBatch(portal, note='clearLocks: %d locks' % cleared)
+    logger.info('clearLocks: cleared %d locks in %.1fs', cleared,
+                time.time() - started)
+    return cleared
+
+
+def readMemberDicts(filename, format=None):
+    """Stream member dictionaries out of a CSV or JSON lines file
+
+    The format is guessed from the extension of the file unless format is
+    'csv' or 'json'. JSON lines files have one member dictionary per line,
+    in the format addUserAccounts expects. CSV files have a header row with
+    an 'id', 'password' and 'roles' column, roles are separated by ';' and
+    every other column is passed along as a property.
+    """
+    if format is None:
+        format = os.path.splitext(filename)[1].lstrip('.').lower()
+        if format in ('jsonl', 'ndjson'):
+            format = 'json'
+    f = open(filename, 'rb')
+    try:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                mem = {
+                    'id': row.pop('id'),
+                    'password': row.pop('password'),
+                    'roles': [role.strip() for role in
+                              row.pop('roles', '').split(';')
+                              if role.strip()],
+                }
+                mem['properties'] = row
+                yield mem
+        elif format == 'json':
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            raise ValueError('Unknown member file format: %s' % format)
+    finally:
+        f.close()
 
 
+@instrumented
+def importUserAccounts(source, batch_size=500, format=None,
+                       prefetch_ids=True):
+    """Add user accounts into the system in bulk
+
+    source is an iterable of member dictionaries (see addUserAccounts) or
+    the name of a CSV or JSON lines file to stream them from, see
+    readMemberDicts.
+
+    The existing login ids are fetched once up front, and the work is
+    committed every batch_size new members with the throughput of the
+    batch logged. Returns a dictionary with the number of members 'added'
+    and 'skipped'.
+
+    Listing the existing ids lists every user of the user sources (e.g. a
+    whole LDAP directory), pass prefetch_ids=False for small imports to
+    rely on the registration tool refusing taken ids instead.
+    """
+    if isinstance(source, basestring):
+        source = readMemberDicts(source, format)
+    portal = getSite()
+    rtool = getToolByName(portal, 'portal_registration')
+    mtool = getToolByName(portal, 'portal_membership')
+    rta = rtool.addMember
+    if prefetch_ids:
+        existing = set(mtool.listMemberIds())
+    else:
+        existing = set()
+    added = skipped = 0
+    started = batch_started = time.time()
+    for mem in source:
+        if mem['id'] in existing:
+            skipped += 1
+            msg = '\nlogin id %s is already taken...\n*********\n' % mem['id']
+            logger.debug(msg)
+            continue
+        try:
+            rta(
+                id=mem['id'],
+                password=mem['password'],
+                roles=mem['roles'],
+                properties=mem['properties'],
+            )
+        except ValueError:
+            skipped += 1
+            msg = '\nlogin id %s is already taken...\n*********\n' % mem['id']
+            logger.debug(msg)
+            continue
+        existing.add(mem['id'])
+        added += 1
+        countObjects()
+        if batch_size and not added % batch_size:
+            _commitBatch(portal, note='importUserAccounts: %d members' % added)
+            elapsed = time.time() - batch_started
+            logger.info('importUserAccounts: %d members added, batch of %d '
+                        'in %.1fs (%.1f members/sec)', added, batch_size,
+                        elapsed, elapsed and batch_size / elapsed or 0.0)
+            batch_started = time.time()
+    if batch_size:
+        _commitBatch(portal, note='importUserAccounts: %d members' % added)
+    logger.info('importUserAccounts: %d members added, %d skipped in %.1fs',
+                added, skipped, time.time() - started)
+    return {'added': added, 'skipped': skipped}
+
+
+@instrumented
 def addUserAccounts(member_dicts=[]):
     """Add user accounts into the system
 
@@ -255,26 +1161,17 @@ def addUserAccounts(member_dicts=[]):
 
     Additional properties can be added in the properties item and will
     be passed along to the registration tool.
+
+    Use importUserAccounts for large imports.
     """
-    portal = getSite()
-    rtool = getToolByName(portal, 'portal_registration')
-    rta = rtool.addMember
-    for mem in member_dicts:
-        try:
-            rta(
-                id=mem['id'],
-                password=mem['password'],
-                roles=mem['roles'],
-                properties=mem['properties'],
-            )
-        except ValueError:
-            msg = '\nlogin id %s is already taken...\n*********\n' % mem['id']
-            logger.debug(msg)
+    importUserAccounts(member_dicts, batch_size=None, prefetch_ids=False)
 
 
+@instrumented
 def addRememberUserAccounts(member_dicts=[],
                             initial_transition="register_private",
-                            send_emails=False, portal_type='Member'):
+                            send_emails=False, portal_type='Member',
+                            batch_size=None):
     """Add remember user accounts into the system
 
     Member dictionaries are in the following format::
@@ -291,6 +1188,9 @@ def addRememberUserAccounts(member_dicts=[],
     You can pass in more 'fieldName': 'values' in the dictionary, they will be
     passed on to processForm.
 
+    member_dicts can be any iterable, e.g. a generator streaming the
+    members from disk, or the name of a JSON lines file to read them from.
+
     initial_transition is the member workflow transition you want to
     run on the members. Pass in a list to run multiple transitions.
     Pass in a list of tuples (transition, comment) if you want to add
@@ -298,11 +1198,18 @@ def addRememberUserAccounts(member_dicts=[],
 
     If send_emails is True then registration emails will be sent out
     to the users.
+
+    The new members are not indexed while they are created, processed
+    and transitioned, each of them is indexed once at the end of its
+    batch of batch_size members and the batch is committed. Without a
+    batch_size everything is done in the current transaction.
     """
     # BBB make sure a string or a list works
     #     this used to be just one transition.
     if isinstance(initial_transition, str):
         initial_transition = [initial_transition]
+    if isinstance(member_dicts, basestring):
+        member_dicts = readMemberDicts(member_dicts, 'json')
     portal = getSite()
     # store the current prop
     current_setting = portal.validate_email
@@ -311,15 +1218,25 @@ def addRememberUserAccounts(member_dicts=[],
         portal.validate_email = 0
     mdata = getToolByName(portal, 'portal_memberdata')
     wftool = getToolByName(portal, 'portal_workflow')
-    existing_members = mdata.contentIds()
-    for mem in member_dicts:
-        if mem['id'] not in existing_members:
-            mdata.invokeFactory(portal_type, mem['id'])
-            new_member = getattr(mdata, mem['id'])
+    existing_members = set(mdata.contentIds())
+    batch = []
+    added = 0
+    started = time.time()
+    paused = _pauseIndexing(portal, portal_type)
+    try:
+        for mem in member_dicts:
+            mem_id = mem['id']
+            if mem_id in existing_members:
+                msg = '\nlogin id %s is already taken...\n*********\n' % mem_id
+                logger.debug(msg)
+                continue
+            mdata.invokeFactory(portal_type, mem_id)
+            new_member = getattr(mdata, mem_id)
             # remove id as it's already set
-            del mem['id']
+            values = dict(mem)
+            del values['id']
             # finalize creation of the member
-            new_member.processForm(values=mem)
+            new_member.processForm(values=values)
             # now we can register the member since it is 'valid'
             # XXX we default to the approval workflow
             for transition in initial_transition:
@@ -329,15 +1246,72 @@ def addRememberUserAccounts(member_dicts=[],
                 else:
                     comment = ''
                 wftool.doActionFor(new_member, transition, comment=comment)
-            # reindex again to update the state info in the catalog
-            new_member.reindexObject()
-        else:
-            msg = '\nlogin id %s is already taken...\n*********\n' % mem['id']
-            logger.debug(msg)
-    # but the property back
-    portal.validate_email = current_setting
+            existing_members.add(mem_id)
+            batch.append(new_member)
+            added += 1
+            countObjects()
+            if batch_size and len(batch) >= batch_size:
+                # don't commit the turned off email validation and
+                # indexing
+                portal.validate_email = current_setting
+                _resumeIndexing(paused)
+                paused = None
+                _reindexMembers(batch)
+                batch = []
+                _commitBatch(portal,
+                             note='addRememberUserAccounts: %d' % added)
+                if not send_emails:
+                    portal.validate_email = 0
+                paused = _pauseIndexing(portal, portal_type)
+                logger.info('addRememberUserAccounts: %d members added in '
+                            '%.1fs', added, time.time() - started)
+        _resumeIndexing(paused)
+        paused = None
+        _reindexMembers(batch)
+    finally:
+        # put the property back
+        portal.validate_email = current_setting
+        if paused is not None:
+            _resumeIndexing(paused)
+    if batch_size:
+        _commitBatch(portal, note='addRememberUserAccounts: %d' % added)
+
+
+def _pauseIndexing(portal, portal_type):
+    """Keep Archetypes objects of portal_type out of the catalogs
+
+    They are indexed in the catalogs the archetype_tool maps their type
+    to, mapping it to no catalog turns indexing off. Returns what
+    _resumeIndexing needs to put the mapping back.
+    """
+    from Products.Archetypes.config import CATALOGMAP_USES_PORTALTYPE
+    at = getToolByName(portal, 'archetype_tool')
+    key = portal_type
+    if not CATALOGMAP_USES_PORTALTYPE:
+        ttool = getToolByName(portal, 'portal_types')
+        key = ttool.getTypeInfo(portal_type).content_meta_type
+    previous = at.catalog_map.get(key)
+    at.setCatalogsByType(key, [])
+    return at, key, previous
+
+
+def _resumeIndexing(paused):
+    at, key, previous = paused
+    if previous is None:
+        del at.catalog_map[key]
+    else:
+        at.setCatalogsByType(key, previous)
+
+
+def _reindexMembers(members):
+    """Index the members once to add them with their state to the catalogs
+    """
+    for member in members:
+        member.reindexObject()
 
 
+@instrumented
+@profiled
 def updateSchema(update_types=[],
                  update_all=False,
                  remove_inst_schemas=True):
@@ -362,6 +1336,65 @@ def updateSchema(update_types=[],
     portal.archetype_tool.manage_updateSchema(req)
 
 
+@instrumented
+def updateSchemaBatched(update_types=[], path=None, update_all=False,
+                        remove_inst_schemas=True, batch_size=500):
+    """Update archetype schemas for specific types, in batches
+
+    update_types is the same list as for updateSchema. Unlike updateSchema
+    the objects are found with the catalog, so they can be restricted to a
+    PhysicalPath, objects whose schema is already current are skipped
+    (unless update_all is True) and the work is committed every
+    batch_size objects. Objects missing from the catalog are not updated.
+
+    The types are only marked as updated in the archetype_tool when the
+    whole site was handled. Returns a dictionary with the number of
+    objects 'updated' and 'current'.
+    """
+    from Products.Archetypes.ArchetypeTool import _types
+    portal = getSite()
+    at = getToolByName(portal, 'archetype_tool')
+    keys = []
+    for key in update_types:
+        if key in _types:
+            keys.append(key)
+        else:
+            logger.warning('updateSchemaBatched: unknown type %s', key)
+    if not keys:
+        # an empty meta_type query would match the whole site
+        return {'updated': 0, 'current': 0}
+    query = {'meta_type': [_types[key]['meta_type'] for key in keys]}
+    objs = walkObjects(query, path, unrestricted=True, portal=portal)
+    total = len(objs)
+    started = time.time()
+    updated = current = count = 0
+    for obj in objs:
+        count += 1
+        # an instance schema is only removed by _updateSchema, and
+        # _isSchemaCurrent would compare against it
+        instance_schema = remove_inst_schemas and \
+            'schema' in aq_base(obj).__dict__
+        if not update_all and not instance_schema and \
+                obj._isSchemaCurrent():
+            current += 1
+        else:
+            obj._updateSchema(remove_instance_schemas=remove_inst_schemas)
+            updated += 1
+        if batch_size and not count % batch_size:
+            _commitBatch(portal,
+                         note='updateSchemaBatched: %d objects' % count)
+            _logProgress('updateSchemaBatched', count, total, started)
+    if path is None:
+        for key in keys:
+            at._types[key] = _types[key]['schema'].signature()
+        at._p_changed = True
+    if batch_size:
+        _commitBatch(portal, note='updateSchemaBatched: %d objects' % count)
+    logger.info('updateSchemaBatched: %d objects updated, %d already '
+                'current in %.1fs', updated, current, time.time() - started)
+    return {'updated': updated, 'current': current}
+
+
 def setPolicyOnObject(obj, policy_in=None, policy_below=None):
     """Set the placeful workflow policy on an object
 
@@ -371,17 +1404,79 @@ def setPolicyOnObject(obj, policy_in=None, policy_below=None):
 
     policy_below is the policy set on all the items below obj
     """
+    _setPolicy(obj, policy_in, policy_below)
+
+
+def _setPolicy(obj, policy_in=None, policy_below=None,
+               update_existing=False):
+    """Set the policies, returns True if the object got a new config or
+    its policies changed
+    """
     placeful_workflow = getToolByName(obj, 'portal_placeful_workflow')
     if not base_hasattr(obj, '.wf_policy_config'):
         cmfpw = 'CMFPlacefulWorkflow'
         obj.manage_addProduct[cmfpw].manage_addWorkflowPolicyConfig()
-        config = placeful_workflow.getWorkflowPolicyConfig(obj)
-        if policy_in is not None:
-            config.setPolicyIn(policy=policy_in)
-        if policy_below is not None:
-            config.setPolicyBelow(policy=policy_below)
-
-
+    elif not update_existing:
+        return False
+    config = placeful_workflow.getWorkflowPolicyConfig(obj)
+    changed = False
+    if policy_in is not None and config.getPolicyInId() != policy_in:
+        config.setPolicyIn(policy=policy_in)
+        changed = True
+    if policy_below is not None and \
+            config.getPolicyBelowId() != policy_below:
+        config.setPolicyBelow(policy=policy_below)
+        changed = True
+    return changed
+
+
+@instrumented
+def setPolicyOnObjects(objs, policy_in=None, policy_below=None,
+                       update_security=True, batch_size=None,
+                       update_existing=True):
+    """Set the placeful workflow policy on many objects at once
+
+    objs is a list of objects or paths, see setPolicyOnObject for the
+    policies. Objects that already have a policy config get the new
+    policies, pass update_existing=False to leave them alone instead.
+
+    Afterwards the role mappings are updated and the security reindexed
+    for the objects whose policies changed only: the objects themselves,
+    and everything below them when policy_below is set. This replaces
+    running updateSecurity on the whole site.
+
+    Returns a dictionary with the paths of the objects whose policies
+    were 'set' and of the ones 'skipped' (already configured, or left as
+    they were), and the number of objects 'checked' and 'changed' by the
+    security update.
+    """
+    portal = getSite()
+    paths = []
+    skipped = []
+    for obj in objs:
+        if isinstance(obj, basestring):
+            obj = portal.unrestrictedTraverse(obj)
+        obj_path = '/'.join(obj.getPhysicalPath())
+        if _setPolicy(obj, policy_in, policy_below, update_existing):
+            paths.append(obj_path)
+        else:
+            skipped.append(obj_path)
+    if skipped and not update_existing:
+        logger.warning('setPolicyOnObjects: %d objects already have a '
+                       'policy config and were skipped: %s', len(skipped),
+                       ', '.join(skipped))
+    elif skipped:
+        logger.info('setPolicyOnObjects: %d objects already had these '
+                    'policies', len(skipped))
+    result = {'set': paths, 'skipped': skipped, 'checked': 0, 'changed': 0}
+    if update_security and paths:
+        result.update(_updateSecurityForPaths(
+            portal, paths, recursive=policy_below is not None,
+            batch_size=batch_size, name='setPolicyOnObjects'))
+    return result
+
+
+@instrumented
 def runPortalMigration(context=None):
     """Run any migrations that are pending
     """
@@ -393,76 +1488,268 @@ def runPortalMigration(context=None):
         pm.upgrade()
 
 
-def removeCustomContent(context=None, del_args=[], is_custom_folder=True):
+@instrumented
+def removeCustomContent(context=None, del_args=[], is_custom_folder=True,
+                        dry_run=False, batch_size=None):
     """Remove the elements from the argument list from portal_skins/custom if
        is_custom_folder is true, otherwise from the portal_view_customizations
        Remove everything if the list is empty.
+
+       Arguments can be ids, glob patterns like 'plone*.css' or regular
+       expressions prefixed with 're:' like 're:^(foo|bar)_'.
+
+       The ids to remove are returned. Pass dry_run=True to only list them,
+       and batch_size to delete and commit them in batches.
     """
     portal = getSite()
     custom_folder = getToolByName(portal, 'portal_skins').custom
     if not is_custom_folder:
         custom_folder = getToolByName(portal, "portal_view_customizations")
+    object_ids = custom_folder.objectIds()
     if is_custom_folder and not del_args:
-        del_args = custom_folder.objectIds()
+        del_args = object_ids
 
     # goodbye EVIL!!!
-    existfiles = []
+    existing = set(object_ids)
+    to_delete = set()
     for del_arg in del_args:
-        if del_arg not in custom_folder.objectIds():
+        if del_arg in existing:
+            matches = [del_arg]
+        elif del_arg.startswith('re:'):
+            pattern = re.compile(del_arg[3:])
+            matches = [obj_id for obj_id in object_ids
+                       if pattern.search(obj_id)]
+        elif [char for char in '*?[' if char in del_arg]:
+            matches = fnmatch.filter(object_ids, del_arg)
+        else:
+            matches = []
+        if not matches:
             logger.warning("*** FILE '%s' doesn't exist in the custom folder"\
                            % del_arg)
-        else:
-            existfiles.append(del_arg)
-    custom_folder.manage_delObjects(existfiles)
-
-
-def disableLDAPPlugins(portal=None):
-    """Disable the LDAP connections from acl_users
+        to_delete.update(matches)
+    # keep the order of the folder
+    existfiles = [obj_id for obj_id in object_ids if obj_id in to_delete]
+    if dry_run:
+        for obj_id in existfiles:
+            logger.info('removeCustomContent would remove %s', obj_id)
+        return existfiles
+    if not batch_size:
+        custom_folder.manage_delObjects(existfiles)
+        return existfiles
+    for start in range(0, len(existfiles), batch_size):
+        custom_folder.manage_delObjects(existfiles[start:start + batch_size])
+        done = min(start + batch_size, len(existfiles))
+        _commitBatch(portal, note='removeCustomContent: %d objects' % done)
+        logger.info('removeCustomContent: removed %d of %d objects', done,
+                    len(existfiles))
+    return existfiles
+
+
+def findPloneSites(root):
+    """Return every Plone site in the Zope root, including the ones in
+    folders
     """
-    ldap_list = ['Plone Active Directory plugin',
-                 'Plone LDAP plugin',
-                 'LDAP Multi Plugin',
-                 'ActiveDirectory Multi Plugin']
-    if portal is None:
-        portal = getSite()
-    acl = portal.acl_users
-    to_disable = []
-    for value in acl.values():
-        if value.meta_type in ldap_list:
-            to_disable.append(value.id)
-    for ldap_plugin_id in to_disable:
-        # turn off the ldap plugin for local testing
-        interfaces = [
-          "IAuthenticationPlugin",
-          "ICredentialsResetPlugin",
-          "IGroupEnumerationPlugin",
-          "IGroupIntrospection",
-          "IGroupManagement",
-          "IGroupsPlugin",
-          "IPropertiesPlugin",
-          "IRoleEnumerationPlugin",
-          "IRolesPlugin",
-          "IUserEnumerationPlugin"
-        ]
+    sites = []
+    for obj in root.objectValues():
+        if IPloneSiteRoot.providedBy(obj):
+            sites.append(obj)
+        elif obj.meta_type in ('Folder', 'Folder (Ordered)'):
+            sites.extend(findPloneSites(obj))
+    return sites
+
+
+@instrumented
+def togglePASPlugins(portal=None, meta_types=LDAP_META_TYPES, enable=False,
+                     interfaces=LDAP_INTERFACES, root=None, restore=None):
+    """Enable or disable the acl_users plugins of the given meta types
+
+    The plugins are (de)activated for the given interface names, on the
+    portal (the current site by default) or, if a Zope root is passed in,
+    on every Plone site in it.
+
+    Disabling records the interfaces each plugin was active for and its
+    position in the plugin lists, in the changes returned and in the
+    annotations of the site. Enabling restores exactly that, taking the
+    record from restore (the changes returned when disabling) or from the
+    site. Only the recorded plugins of meta_types are restored, and only
+    for interfaces, the others stay recorded as disabled. Sites without a
+    record get the plugins activated for every interface they provide, at
+    the end of the plugin lists.
+
+    Returns the changes as a list of (acl_users path, plugin id,
+    interface name, 'enabled' or 'disabled', position) tuples.
+    """
+    if root is not None:
+        sites = findPloneSites(root)
+    elif portal is not None:
+        sites = [portal]
+    else:
+        sites = [getSite()]
+    # interface names resolved once for all the plugins and sites
+    resolved = {}
+    changes = []
+    for site in sites:
+        acl = site.acl_users
+        acl_path = '/'.join(acl.getPhysicalPath())
         # this code is mostly taken from
         # Products.PluggableAuthService.
         # plugins.BasePlugin.manage_activateInterfaces
-        ldap_plugin = portal.acl_users[ldap_plugin_id]
-        pas_instance = ldap_plugin._getPAS()
-        plugins = pas_instance._getOb('plugins')
-        active_interfaces = []
+        plugins = acl._getOb('plugins')
         for iface_name in interfaces:
-            active_interfaces.append(
-                plugins._getInterfaceFromName(iface_name))
+            _resolveInterface(plugins, iface_name, resolved)
+        annotations = IAnnotations(site)
+        if not enable:
+            site_changes = _disablePlugins(acl, acl_path, plugins,
+                                           meta_types, interfaces, resolved)
+            if site_changes:
+                annotations[DISABLED_PLUGINS_KEY] = \
+                    annotations.get(DISABLED_PLUGINS_KEY, []) + site_changes
+        else:
+            record = [change for change in restore or ()
+                      if change[0] == acl_path]
+            if not record:
+                record = annotations.get(DISABLED_PLUGINS_KEY)
+            if record is None:
+                logger.warning('%s: nothing recorded as disabled, enabling '
+                               'the plugins at the end of the plugin lists',
+                               acl_path)
+                site_changes = _enablePlugins(acl, acl_path, plugins,
+                                              meta_types, interfaces,
+                                              resolved)
+            else:
+                record = [change for change in record
+                          if _recordedFor(acl, change, meta_types,
+                                          interfaces)]
+                site_changes = _restorePlugins(acl_path, plugins, record,
+                                               resolved)
+            if DISABLED_PLUGINS_KEY in annotations:
+                # the other plugins and interfaces stay disabled
+                remaining = [change for change
+                             in annotations[DISABLED_PLUGINS_KEY]
+                             if not _recordedFor(acl, change, meta_types,
+                                                 interfaces)]
+                if remaining:
+                    annotations[DISABLED_PLUGINS_KEY] = remaining
+                else:
+                    del annotations[DISABLED_PLUGINS_KEY]
+        changes.extend(site_changes)
+    logger.info('togglePASPlugins: %d changes on %d sites', len(changes),
+                len(sites))
+    return changes
 
-        for iface in active_interfaces:
-            try:
-                plugins.deactivatePlugin(iface, ldap_plugin_id)
-            except KeyError:
-                print "%s plugin already disabled for %s" % (
-                    iface, ldap_plugin_id)
+
+def _resolveInterface(plugins, iface_name, resolved):
+    if iface_name not in resolved:
+        try:
+            resolved[iface_name] = plugins._getInterfaceFromName(iface_name)
+        except KeyError:
+            logger.warning('Unknown plugin interface %s', iface_name)
+            resolved[iface_name] = None
+    return resolved[iface_name]
+
+
+def _recordedFor(acl, change, meta_types, interfaces):
+    """Check if a recorded change is about a plugin of one of meta_types
+    and one of interfaces
+    """
+    if change[2] not in interfaces:
+        return False
+    plugin = acl._getOb(change[1], None)
+    return plugin is not None and plugin.meta_type in meta_types
+
+
+def _disablePlugins(acl, acl_path, plugins, meta_types, interfaces,
+                    resolved):
+    changes = []
+    for iface_name in interfaces:
+        iface = resolved[iface_name]
+        if iface is None:
+            continue
+        # the positions before anything is deactivated
+        active = list(plugins.listPluginIds(iface))
+        for plugin in acl.objectValues():
+            plugin_id = plugin.getId()
+            if plugin.meta_type not in meta_types or plugin_id not in active:
+                continue
+            plugins.deactivatePlugin(iface, plugin_id)
+            changes.append((acl_path, plugin_id, iface_name, 'disabled',
+                            active.index(plugin_id)))
+            logger.info('%s disabled plugin %s for %s', acl_path, plugin_id,
+                        iface_name)
+    return changes
+
+
+def _restorePlugins(acl_path, plugins, record, resolved):
+    """Activate the plugins of record at their recorded positions
+    """
+    changes = []
+    # restoring the lowest positions first puts every plugin back in place
+    entries = [(change[2], change[4], change[1]) for change in record
+               if change[0] == acl_path and change[3] == 'disabled']
+    entries.sort()
+    for iface_name, position, plugin_id in entries:
+        iface = _resolveInterface(plugins, iface_name, resolved)
+        if iface is None:
+            continue
+        if plugin_id not in plugins.listPluginIds(iface):
+            plugins.activatePlugin(iface, plugin_id)
+        active = list(plugins.listPluginIds(iface))
+        for i in range(active.index(plugin_id) - min(position,
+                                                     len(active) - 1)):
+            plugins.movePluginsUp(iface, [plugin_id])
+        changes.append((acl_path, plugin_id, iface_name, 'enabled',
+                        list(plugins.listPluginIds(iface)).index(plugin_id)))
+        logger.info('%s enabled plugin %s for %s', acl_path, plugin_id,
+                    iface_name)
+    return changes
+
+
+def _enablePlugins(acl, acl_path, plugins, meta_types, interfaces,
+                   resolved):
+    changes = []
+    for plugin in acl.objectValues():
+        if plugin.meta_type not in meta_types:
+            continue
+        plugin_id = plugin.getId()
+        for iface_name in interfaces:
+            iface = resolved[iface_name]
+            if iface is None or not iface.providedBy(plugin):
+                continue
+            if plugin_id in plugins.listPluginIds(iface):
+                continue
+            plugins.activatePlugin(iface, plugin_id)
+            changes.append((acl_path, plugin_id, iface_name, 'enabled',
+                            len(plugins.listPluginIds(iface)) - 1))
+            logger.info('%s enabled plugin %s for %s', acl_path, plugin_id,
+                        iface_name)
+    return changes
+
+
+@instrumented
+def disableLDAPPlugins(portal=None, root=None):
+    """Disable the LDAP connections from acl_users
+
+    Pass in a Zope root to disable them on every Plone site in it. What
+    was disabled is recorded so enableLDAPPlugins can put it back.
+    """
+    # turn off the ldap plugins for local testing
+    return togglePASPlugins(portal, enable=False, root=root)
+
+
+@instrumented
+def enableLDAPPlugins(portal=None, root=None, restore=None):
+    """Enable the LDAP connections in acl_users again
+
+    This undoes disableLDAPPlugins, e.g. when restoring production data:
+    the plugins are activated for the interfaces they were active for, at
+    the same positions. Pass in a Zope root to enable them on every Plone
+    site in it, and the changes disableLDAPPlugins returned as restore if
+    the record kept in the sites is not available.
+    """
+    return togglePASPlugins(portal, enable=True, root=root, restore=restore)
 
 
+@instrumented
 def catalog_progress(context=None, progress=500):
     """Set the catalog progress level so that we don't forget to
     set it when it really counts.
@@ -472,13 +1759,26 @@ def catalog_progress(context=None, progress=500):
     catalog.manage_setProgress(progress)
     logger.warn("The catalog will now log progress at %s items" % progress)
 
-def refreshAssetRegistry(assets=['javascripts', 'css', 'kss']):
+@instrumented
+@profiled
+def refreshAssetRegistry(assets=['javascripts', 'css', 'kss'], force=False,
+                         prewarm_url=None, prewarm_threads=4):
     """Refreshes an asset registry or all asset registries
 
     The 'assets' kwarg can be a list with any combination of
     'javascripts', 'css', 'kss'. By default, all of them are updated.
+
+    A registry is only cooked again when its resources (their settings
+    and the modification times of the files) changed since the last
+    refresh, pass force=True to cook anyway.
+
+    Pass in the public URL of the site as prewarm_url to fetch the cooked
+    resources with prewarm_threads concurrent requests once the
+    transaction is committed, so the first visitors after a deploy don't
+    pay for merging them.
     """
     portal = getSite()
+    urls = []
     for entry in assets:
         if entry == 'kss':
             try:
@@ -487,16 +1787,123 @@ def refreshAssetRegistry(assets=['javascripts', 'css', 'kss']):
                 continue
         else:
             registry = getToolByName(portal, 'portal_%s' % entry)
-        registry.cookResources()
+        fingerprint = _registryFingerprint(portal, registry)
+        previous = getattr(aq_base(registry), FINGERPRINT_ATTR, None)
+        if not force and previous == fingerprint:
+            logger.info('refreshAssetRegistry: %s is unchanged', entry)
+        else:
+            registry.cookResources()
+            setattr(registry, FINGERPRINT_ATTR, fingerprint)
+        if prewarm_url is not None:
+            base_url = '%s/%s' % (prewarm_url.rstrip('/'), registry.getId())
+            for resource in registry.getCookedResources():
+                urls.append('%s/%s' % (base_url, quote(resource.getId())))
+    if urls:
+        transaction.get().addAfterCommitHook(_prewarmAssets,
+                                             (urls, prewarm_threads))
+
+
+def _resourceModificationTime(obj):
+    """The modification time of the file behind a resource, if any
+    """
+    if obj is None:
+        return None
+    base = aq_base(obj)
+    filepath = getattr(base, '_filepath', None)
+    if filepath is None:
+        # browser resources
+        filepath = getattr(getattr(base, 'context', None), 'path', None)
+    if filepath is not None:
+        try:
+            return os.path.getmtime(filepath)
+        except OSError:
+            return None
+    return getattr(base, '_p_mtime', None)
+
+
+def _registryFingerprint(portal, registry):
+    """Hash the settings of the resources and their modification times
+    """
+    digest = md5()
+    for resource in registry.getResources():
+        data = getattr(resource, '_data', {})
+        digest.update(repr(sorted(data.items())))
+        try:
+            obj = portal.unrestrictedTraverse(resource.getId(), None)
+        except Exception:
+            obj = None
+        digest.update(repr(_resourceModificationTime(obj)))
+    return digest.hexdigest()
+
+
+def _prewarmAssets(status, urls, threads=4, timeout=60):
+    """After commit hook fetching the cooked resources concurrently
+
+    The fetching threads are waited for, each request gets timeout
+    seconds. Returns the number of resources fetched.
+    """
+    if not status:
+        return 0
+    import Queue
+    import threading
+    import urllib2
+    queue = Queue.Queue()
+    for url in urls:
+        queue.put(url)
+    warmed = []
+
+    def fetch():
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Queue.Empty:
+                return
+            started = time.time()
+            try:
+                urllib2.urlopen(url, timeout=timeout).read()
+            except Exception, e:
+                logger.warning('Could not prewarm %s: %s', url, e)
+            else:
+                warmed.append(url)
+                logger.info('Prewarmed %s in %.1fs', url,
+                            time.time() - started)
+
+    workers = []
+    for i in range(min(threads, len(urls))):
+        thread = threading.Thread(target=fetch, name='prewarm-%d' % i)
+        # a hanging server must not keep the process alive
+        thread.setDaemon(True)
+        thread.start()
+        workers.append(thread)
+    if workers:
+        # every thread fetches its share of the urls one after the other
+        rounds = (len(urls) + len(workers) - 1) // len(workers)
+        deadline = time.time() + rounds * timeout
+        for thread in workers:
+            thread.join(max(deadline - time.time(), 0))
+    logger.info('Prewarmed %d of %d bundles', len(warmed), len(urls))
+    return len(warmed)
+
+
+_package_references = {}
+
 
 def resolvePackageReference(reference):
     """stolen from collective.transmogrifier.utils
+
+    The resolved references are remembered.
     """
-    package, filename = reference.strip().split(':', 1)
-    package = __import__(package, {}, {}, ('*',))
-    return os.path.join(os.path.dirname(package.__file__), filename)
+    reference = reference.strip()
+    resolved = _package_references.get(reference)
+    if resolved is None:
+        package, filename = reference.split(':', 1)
+        package = __import__(package, {}, {}, ('*',))
+        resolved = os.path.join(os.path.dirname(package.__file__), filename)
+        _package_references[reference] = resolved
+    return resolved
 
 
+@instrumented
 def disable_acl_user_cache(context):
     site = getSite()
     zope_root = aq_parent(site)
@@ -504,3 +1911,94 @@ def disable_acl_user_cache(context):
     zope_root.acl_users.ZCacheable_setEnabled(False)
     site.acl_users.ZCacheable_setManagerId(None)
     site.acl_users.ZCacheable_setEnabled(False)
+
+
+######################################################
+# Running helpers on every Plone site of a Zope root
+
+
+def _helperName(helper):
+    if isinstance(helper, basestring):
+        return helper
+    return '%s.%s' % (helper.__module__, helper.__name__)
+
+
+def _runOnSite(site, helper, args=(), kw=None):
+    """Run helper with site as the current site, in its own transaction
+
+    Failures are logged and reported instead of raised. Returns a
+    dictionary with the 'site' path, 'status', 'seconds' and 'error'.
+    """
+    if isinstance(helper, basestring):
+        from zope.dottedname.resolve import resolve
+        helper = resolve(helper)
+    name = _helperName(helper)
+    site_path = '/'.join(site.getPhysicalPath())
+    result = {'site': site_path, 'helper': name, 'status': 'ok',
+              'error': None}
+    original = getSite()
+    started = time.time()
+    setSite(site)
+    try:
+        try:
+            helper(*args, **(kw or {}))
+            txn = transaction.get()
+            txn.note('%s on %s' % (name, site_path))
+            txn.commit()
+        except Exception, e:
+            transaction.abort()
+            logger.exception('%s failed on %s', name, site_path)
+            result['status'] = 'failed'
+            result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        result['seconds'] = time.time() - started
+        setSite(original)
+    logger.info('%s on %s: %s in %.1fs', name, site_path, result['status'],
+                result['seconds'])
+    return result
+
+
+@instrumented
+def runOnAllSites(helper, root=None, args=(), kw=None, processes=None,
+                  zope_conf=None, db_factory=None):
+    """Run a helper on every Plone site of a Zope root
+
+    helper is a function or its dotted name, it is called with args and
+    kw with each site set as the current site. Every site gets its own
+    transaction, so work already done by the caller should be committed
+    first, with processes it is aborted before the workers start. A
+    failing site is aborted and logged, and the next site is run.
+
+    root defaults to the Zope root of the current site. Pass in a number
+    of processes to spread the sites over worker processes with their own
+    ZODB connections (see sixfeetup.utils.parallel), the helper has to be
+    importable by its dotted name then.
+
+    Returns a list of dictionaries with the 'site', 'status', 'seconds'
+    and 'error' of each site, which is also logged as a summary.
+    """
+    if root is None:
+        root = getSite().getPhysicalRoot()
+    sites = findPloneSites(root)
+    name = _helperName(helper)
+    logger.info('runOnAllSites: %s on %d sites', name, len(sites))
+    if processes:
+        from sixfeetup.utils.parallel import _detachConnection
+        from sixfeetup.utils.parallel import runOnSitesInProcesses
+        site_paths = ['/'.join(site.getPhysicalPath()) for site in sites]
+        _detachConnection(root._p_jar)
+        results = runOnSitesInProcesses(site_paths, name, args, kw,
+                                        processes, zope_conf, db_factory)
+        # see the work of the workers
+        root._p_jar.sync()
+    else:
+        results = [_runOnSite(site, helper, args, kw) for site in sites]
+    results.sort(key=lambda result: result['seconds'], reverse=True)
+    failed = [result for result in results if result['status'] != 'ok']
+    for result in results:
+        logger.info('runOnAllSites: %(seconds)8.1fs %(status)-6s %(site)s',
+                    result)
+    logger.info('runOnAllSites: %s done on %d sites, %d failed, %.1fs in '
+                'total', name, len(results), len(failed),
+                sum([result['seconds'] for result in results]))
+    return results
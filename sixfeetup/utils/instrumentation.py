@@ -0,0 +1,197 @@
+"""Record where the time of the helpers goes
+
+Every helper wrapped with `instrumented` (or code run inside the
+`instrument` context manager) records its wall time, CPU time, the
+number of objects it processed, the ZODB loads and stores of the site's
+connection and the peak RSS of the process.
+
+The record is logged, with the metrics in the `sixfeetup_metrics`
+attribute of the log record for structured log handlers, and appended as
+a line of JSON to the file named in the SIXFEETUP_UTILS_METRICS
+environment variable. Records of helpers called by other instrumented
+helpers have a 'depth' above 0 and are only logged at DEBUG level.
+
+Only instrument helpers that are called once for a whole job, not the
+ones called for every object.
+
+Helpers wrapped with `profiled` can also be run under cProfile, see
+`profiled` for how to switch it on.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+try:
+        # Plone < 4.3
+            from zope.app.component.hooks import getSite
+except ImportError:
+        # Plone >= 4.3
+            from zope.component.hooks import getSite # NOQA
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENV = 'SIXFEETUP_UTILS_METRICS'
+PROFILE_ENV = 'SIXFEETUP_UTILS_PROFILE'
+PROFILE_TOP_ENV = 'SIXFEETUP_UTILS_PROFILE_TOP'
+
+_local = threading.local()
+
+
+def _activeRecords():
+    records = getattr(_local, 'records', None)
+    if records is None:
+        records = _local.records = []
+    return records
+
+
+def countObjects(count=1):
+    """Add to the number of objects processed by the running helpers
+
+    The objects count for every active record, so a helper calling other
+    helpers gets the total of their objects.
+    """
+    for record in _activeRecords():
+        record['objects'] += count
+
+
+def _transferCounts():
+    jar = getattr(getSite(), '_p_jar', None)
+    if jar is None:
+        return 0, 0
+    return jar.getTransferCounts()
+
+
+def _cpuTime():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _peakRSS():
+    """Peak resident set size of the process in KB
+    """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _startRecord(name):
+    loads, stores = _transferCounts()
+    record = {
+        'name': name,
+        'objects': 0,
+        '_wall': time.time(),
+        '_cpu': _cpuTime(),
+        '_loads': loads,
+        '_stores': stores,
+    }
+    _activeRecords().append(record)
+    return record
+
+
+def _finishRecord(record):
+    active = _activeRecords()
+    if record in active:
+        active.remove(record)
+    loads, stores = _transferCounts()
+    record['started'] = record['_wall']
+    record['wall'] = time.time() - record.pop('_wall')
+    record['cpu'] = _cpuTime() - record.pop('_cpu')
+    record['loads'] = max(loads - record.pop('_loads'), 0)
+    record['stores'] = max(stores - record.pop('_stores'), 0)
+    record['peak_rss'] = _peakRSS()
+    record['depth'] = len(active)
+    if record['depth']:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logger.log(level, '%(name)s: %(wall).2fs wall, %(cpu).2fs cpu, '
+               '%(objects)d objects, %(loads)d loads, %(stores)d stores, '
+               '%(peak_rss)d KB peak RSS', record,
+               extra={'sixfeetup_metrics': record})
+    filename = os.environ.get(METRICS_ENV)
+    if filename:
+        f = open(filename, 'a')
+        try:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        finally:
+            f.close()
+    return record
+
+
+@contextmanager
+def instrument(name):
+    """Record the metrics of the code run inside the with statement
+
+    The record is a dictionary, the metrics are added to it on the way
+    out.
+    """
+    record = _startRecord(name)
+    try:
+        yield record
+    finally:
+        _finishRecord(record)
+
+
+def instrumented(func):
+    """Decorator recording the metrics of every call to func
+    """
+    @wraps(func)
+    def wrapper(*args, **kw):
+        with instrument(func.__name__):
+            return func(*args, **kw)
+    return wrapper
+
+
+def _dumpProfile(profiler, name, profile_dir):
+    """Dump the stats to a .pstats file and log the hottest functions
+    """
+    import pstats
+    from StringIO import StringIO
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    filename = os.path.join(profile_dir, '%s-%s-%d-%d.pstats' % (
+        name, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+        int(time.time() * 1000) % 1000))
+    profiler.dump_stats(filename)
+    top = int(os.environ.get(PROFILE_TOP_ENV, 25))
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(top)
+    logger.info('Profile of %s written to %s\n%s', name, filename,
+                out.getvalue())
+    return filename
+
+
+def profiled(func):
+    """Decorator running func under cProfile when asked to
+
+    Profiling is switched on by passing a profile_dir keyword argument to
+    the helper, or by setting the SIXFEETUP_UTILS_PROFILE environment
+    variable to a directory. Every call then dumps a .pstats file in that
+    directory and logs its top functions by cumulative time, the number of
+    functions is taken from SIXFEETUP_UTILS_PROFILE_TOP (25 by default).
+    """
+    @wraps(func)
+    def wrapper(*args, **kw):
+        profile_dir = kw.pop('profile_dir', None) or \
+            os.environ.get(PROFILE_ENV)
+        if not profile_dir:
+            return func(*args, **kw)
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kw)
+        finally:
+            _dumpProfile(profiler, func.__name__, profile_dir)
+    return wrapper
@@ -0,0 +1,373 @@
+"""Spread bulk work over several processes
+
+Every worker process opens its own ZODB connection, so the storage has to
+be one that several processes can use at the same time (ZEO, RelStorage).
+A plain FileStorage can only be used when there is a single worker; tests
+can pass a `db_factory` that opens a ZEO client for a FileStorage served
+by `ZEO.tests.forker` instead.
+"""
+import logging
+import multiprocessing
+import time
+import transaction
+from Acquisition import aq_base
+from ZODB.POSException import ConflictError
+from zope.annotation.interfaces import IAnnotations
+from Products.CMFCore.utils import getToolByName
+from sixfeetup.utils.instrumentation import countObjects
+from sixfeetup.utils.instrumentation import instrumented
+
+try:
+        # Plone < 4.3
+            from zope.app.component.hooks import getSite, setSite
+except ImportError:
+        # Plone >= 4.3
+            from zope.component.hooks import getSite, setSite # NOQA
+try:
+    from plone.app.discussion.conversation import ANNOTATION_KEY \
+        as DISCUSSION_ANNOTATION_KEY
+except ImportError:
+    DISCUSSION_ANNOTATION_KEY = None
+
+logger = logging.getLogger(__name__)
+
+# state of a worker process, set up by _initWorker
+_worker = {}
+
+
+def openDatabase(zope_conf=None, db_factory=None):
+    """Open a new ZODB database object for this process
+
+    db_factory is a (picklable, module level) callable returning a
+    ZODB.DB. Otherwise the main database of the instance is opened again
+    from its configuration, reading zope_conf first if it is given.
+    """
+    if db_factory is not None:
+        return db_factory()
+    from App.config import getConfiguration
+    if zope_conf is not None:
+        from Zope2.Startup.run import configure
+        configure(zope_conf)
+    factory = getConfiguration().dbtab.getDatabaseFactory(mount_path='/')
+    return factory.open(factory.getName(), {})
+
+
+def openApp(db):
+    """Return the Zope application root from a new connection to db
+
+    The application is wrapped in a fake request and the code runs as the
+    system user, like `bin/instance run` scripts do.
+    """
+    from AccessControl.SecurityManagement import newSecurityManager
+    from AccessControl.SpecialUsers import system
+    from Testing.makerequest import makerequest
+    conn = db.open()
+    app = makerequest(conn.root()['Application'])
+    newSecurityManager(None, system)
+    return app
+
+
+def _detachConnection(jar):
+    """Get the connection of this process out of the way of the workers
+
+    The workers are forked, so they inherit this connection and the
+    storage behind it. They never use it, _initWorker opens a database of
+    their own after the fork, but nothing pending or cached in it should
+    be copied along: the transaction is aborted and the cache emptied.
+    Call this right before creating the pool, and sync the connection
+    once the workers are done to see what they committed.
+    """
+    transaction.abort()
+    jar.cacheMinimize()
+
+
+def _initWorker(zope_conf, db_factory, site_path):
+    db = openDatabase(zope_conf, db_factory)
+    app = openApp(db)
+    _worker['db'] = db
+    _worker['app'] = app
+    if site_path is not None:
+        site = app.unrestrictedTraverse(site_path)
+        setSite(site)
+        _worker['site'] = site
+
+
+def _indexObject(obj, path=None):
+    """Same as the indexObject used by CatalogTool.clearFindAndRebuild
+
+    This includes indexing the plone.app.discussion comments kept in the
+    annotations of the object.
+    """
+    index = getattr(aq_base(obj), 'indexObject', None)
+    if index is not None and callable(index):
+        try:
+            obj.indexObject()
+        except TypeError:
+            # Catalogs have 'indexObject' as well, but they
+            # take different args, and will fail
+            return
+        if DISCUSSION_ANNOTATION_KEY is None:
+            return
+        annotations = IAnnotations(obj, None)
+        if annotations is None or \
+                DISCUSSION_ANNOTATION_KEY not in annotations:
+            return
+        catalog = getToolByName(obj, 'portal_catalog', None)
+        if catalog is None:
+            return
+        conversation = annotations[DISCUSSION_ANNOTATION_KEY].__of__(obj)
+        for comment in conversation.getComments():
+            catalog.indexObject(comment)
+
+
+def _walkTree(obj):
+    """Yield obj and everything below it, in the order ZopeFindAndApply
+    visits them
+    """
+    yield obj
+    if not hasattr(aq_base(obj), 'objectItems'):
+        return
+    try:
+        items = obj.objectItems()
+    except Exception:
+        return
+    for ob_id, ob in items:
+        for sub in _walkTree(ob):
+            yield sub
+
+
+def _indexBatch(batch, retries, note):
+    """Index the objects of a batch and commit them
+
+    On a ConflictError only this batch is aborted and indexed again, up to
+    retries times, the batches committed before it are kept.
+    """
+    attempt = 0
+    while True:
+        try:
+            for obj in batch:
+                _indexObject(obj)
+            transaction.get().note(note)
+            transaction.commit()
+            return
+        except ConflictError:
+            transaction.abort()
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.info('Conflict indexing a batch of %s, retry %d of %d',
+                        note, attempt, retries)
+
+
+def _indexShard(site, shard_path, batch_size, retries):
+    note = 'catalog rebuild: %s' % shard_path
+    count = 0
+    batch = []
+    for obj in _walkTree(site.unrestrictedTraverse(shard_path)):
+        batch.append(obj)
+        if batch_size and len(batch) >= batch_size:
+            _indexBatch(batch, retries, note)
+            count += len(batch)
+            batch = []
+            site._p_jar.cacheGC()
+    _indexBatch(batch, retries, note)
+    count += len(batch)
+    return count
+
+
+def _rebuildShard(task):
+    """Index one shard in a worker
+
+    Failures are returned rather than raised so the other shards go on.
+    """
+    shard_path, batch_size, retries = task
+    site = _worker['site']
+    started = time.time()
+    try:
+        count = _indexShard(site, shard_path, batch_size, retries)
+        error = None
+    except Exception, e:
+        transaction.abort()
+        logger.exception('Could not index %s', shard_path)
+        count = 0
+        error = '%s: %s' % (e.__class__.__name__, e)
+    site._p_jar.cacheGC()
+    return shard_path, count, time.time() - started, error
+
+
+def findShards(portal, shard_depth=1):
+    """Split the content tree into subtrees that can be indexed separately
+
+    Returns (heads, shards): heads are the objects above shard_depth that
+    have to be indexed by themselves, shards are the paths of the subtrees
+    at shard_depth.
+    """
+    heads = []
+    shards = []
+    level = [portal]
+    for depth in range(1, shard_depth + 1):
+        next_level = []
+        for folder in level:
+            if not hasattr(aq_base(folder), 'objectValues'):
+                continue
+            for ob in folder.objectValues():
+                if depth == shard_depth:
+                    shards.append('/'.join(ob.getPhysicalPath()))
+                else:
+                    heads.append(ob)
+                    next_level.append(ob)
+        level = next_level
+    return heads, shards
+
+
+@instrumented
+def parallelRebuildCatalog(context=None, processes=4, shard_depth=1,
+                           batch_size=1000, retries=3, zope_conf=None,
+                           db_factory=None):
+    """Clear and rebuild the catalog using several worker processes
+
+    The content tree is split into the subtrees found at shard_depth below
+    the portal, each worker indexes whole subtrees with its own ZODB
+    connection. All the workers write to the same catalog, so conflicts
+    are expected: the work is committed every batch_size objects and a
+    batch that conflicts is retried up to retries times on its own. Once
+    all the workers are done the connection is synced so that the catalog
+    they built is visible here.
+
+    The cleared catalog is committed before the workers start, and the
+    connection of this process is left alone while they run. Shards a
+    worker failed to index are indexed again in this process. If that
+    fails as well the error is raised and the catalog is left incomplete,
+    the shards that are missing are logged and have to be reindexed (or
+    the rebuild run again) before the site can be used.
+
+    Returns a list of (shard path, objects indexed, seconds, error) tuples,
+    error being None for the shards that were indexed.
+    """
+    portal = getSite()
+    pc = getToolByName(portal, 'portal_catalog')
+    started = time.time()
+    pc.manage_catalogClear()
+    heads, shards = findShards(portal, shard_depth)
+    for ob in heads:
+        _indexObject(ob)
+    transaction.get().note('catalog rebuild: cleared catalog')
+    transaction.commit()
+    logger.info('parallelRebuildCatalog: %d shards over %d processes',
+                len(shards), processes)
+
+    site_path = '/'.join(portal.getPhysicalPath())
+    _detachConnection(portal._p_jar)
+    pool = multiprocessing.Pool(
+        processes, _initWorker, (zope_conf, db_factory, site_path))
+    tasks = [(shard, batch_size, retries) for shard in shards]
+    results = []
+    try:
+        for result in pool.imap_unordered(_rebuildShard, tasks):
+            results.append(result)
+            logger.info('parallelRebuildCatalog: %s, %d objects in %.1fs '
+                        '(%d/%d shards)', result[0], result[1], result[2],
+                        len(results), len(tasks))
+        pool.close()
+    except:
+        pool.terminate()
+        logger.error('parallelRebuildCatalog: the rebuild was interrupted, '
+                     'the catalog of %s is incomplete', site_path)
+        raise
+    finally:
+        pool.join()
+
+    portal._p_jar.sync()
+    failed = [result for result in results if result[3] is not None]
+    if failed:
+        logger.warning('parallelRebuildCatalog: %d shards failed, indexing '
+                       'them in this process: %s', len(failed),
+                       ', '.join([result[0] for result in failed]))
+    for result in failed:
+        shard_started = time.time()
+        try:
+            count = _indexShard(portal, result[0], batch_size, retries)
+        except:
+            transaction.abort()
+            logger.error('parallelRebuildCatalog: could not index %s, the '
+                         'catalog of %s is incomplete, missing shards: %s',
+                         result[0], site_path, ', '.join(
+                             [item[0] for item in
+                              failed[failed.index(result):]]))
+            raise
+        results[results.index(result)] = (
+            result[0], count, time.time() - shard_started, None)
+    total = sum([result[1] for result in results]) + len(heads)
+    countObjects(total)
+    logger.info('parallelRebuildCatalog: %d objects indexed, catalog has '
+                '%d entries, %.1fs', total, len(pc), time.time() - started)
+    return results
+
+
+@instrumented
+def benchmarkCatalogRebuild(context=None, processes=4, **kw):
+    """Compare a serial clearFindAndRebuild with parallelRebuildCatalog
+
+    Both rebuild the whole catalog, so only run this on a copy of the
+    data. Returns a dictionary with the wall-clock seconds of both runs.
+    """
+    portal = getSite()
+    pc = getToolByName(portal, 'portal_catalog')
+    started = time.time()
+    pc.clearFindAndRebuild()
+    transaction.commit()
+    serial = time.time() - started
+    serial_count = len(pc)
+
+    started = time.time()
+    parallelRebuildCatalog(processes=processes, **kw)
+    parallel = time.time() - started
+    result = {
+        'serial': serial,
+        'serial_entries': serial_count,
+        'parallel': parallel,
+        'parallel_entries': len(pc),
+        'processes': processes,
+        'speedup': parallel and serial / parallel or 0.0,
+    }
+    logger.info('benchmarkCatalogRebuild: serial %(serial).1fs, '
+                '%(processes)d processes %(parallel).1fs '
+                '(%(speedup).2fx)', result)
+    return result
+
+
+def _runSiteInWorker(task):
+    from sixfeetup.utils.helpers import _runOnSite
+    site_path, helper_name, args, kw = task
+    app = _worker['app']
+    app._p_jar.sync()
+    site = app.unrestrictedTraverse(site_path)
+    result = _runOnSite(site, helper_name, args, kw)
+    app._p_jar.cacheGC()
+    return result
+
+
+def runOnSitesInProcesses(site_paths, helper_name, args=(), kw=None,
+                          processes=4, zope_conf=None, db_factory=None):
+    """Run the helper named helper_name on every site in worker processes
+
+    See sixfeetup.utils.helpers.runOnAllSites, which uses this. Call
+    _detachConnection for the connection of this process first.
+    """
+    pool = multiprocessing.Pool(
+        processes, _initWorker, (zope_conf, db_factory, None))
+    tasks = [(site_path, helper_name, args, kw) for site_path in site_paths]
+    results = []
+    try:
+        for result in pool.imap_unordered(_runSiteInWorker, tasks):
+            results.append(result)
+            logger.info('runOnSitesInProcesses: %s %s in %.1fs (%d/%d '
+                        'sites)', result['site'], result['status'],
+                        result['seconds'], len(results), len(tasks))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
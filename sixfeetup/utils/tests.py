@@ -1,9 +1,24 @@
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from datetime import datetime
+from functools import partial
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
+import transaction
+from Acquisition import aq_base
 from zope.testing import doctestunit
 from zope.component import testing
 from Testing import ZopeTestCase as ztc
 
+from DateTime import DateTime
 from Products.Five import zcml
 from Products.Five import fiveconfigure
 from Products.PloneTestCase import PloneTestCase as ptc
@@ -11,6 +26,19 @@ from Products.PloneTestCase.layer import PloneSite
 ptc.setupPloneSite()
 
 import sixfeetup.utils
+from sixfeetup.utils import helpers
+from sixfeetup.utils import instrumentation
+from sixfeetup.utils.browser import monkeypatch
+from sixfeetup.utils.browser.monkeypatch import MissingAssetTracker
+from sixfeetup.utils.browser.monkeypatch import isAsset
+
+try:
+        # Plone < 4.3
+            from zope.app.component.hooks import getSite, setSite
+except ImportError:
+        # Plone >= 4.3
+            from zope.component.hooks import getSite, setSite # NOQA
+
 
 class TestCase(ptc.PloneTestCase):
     class layer(PloneSite):
@@ -25,6 +53,1113 @@ class TestCase(ptc.PloneTestCase):
         def tearDown(cls):
             pass
 
+    def afterSetUp(self):
+        setSite(self.portal)
+        self.setRoles(['Manager'])
+
+    def review_states(self, objs):
+        wftool = self.portal.portal_workflow
+        return [wftool.getInfoFor(obj, 'review_state') for obj in objs]
+
+
+class FunctionalTestCase(ztc.Functional, TestCase):
+    """For the helpers that commit, each test gets its own sandbox
+    """
+
+
+class _Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = _Records()
+        self.logger = logging.getLogger(instrumentation.__name__)
+        self.level = self.logger.level
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+        os.environ.pop(instrumentation.METRICS_ENV, None)
+        shutil.rmtree(self.tmp)
+
+    def metrics(self):
+        return [(record.sixfeetup_metrics['name'],
+                 record.sixfeetup_metrics['objects'],
+                 record.sixfeetup_metrics['depth'], record.levelno)
+                for record in self.handler.records]
+
+    def test_nested(self):
+        @instrumentation.instrumented
+        def inner():
+            instrumentation.countObjects(2)
+
+        @instrumentation.instrumented
+        def outer():
+            inner()
+            instrumentation.countObjects()
+
+        outer()
+        self.assertEqual(self.metrics(),
+                         [('inner', 2, 1, logging.DEBUG),
+                          ('outer', 3, 0, logging.INFO)])
+
+    def test_failing_helper(self):
+        @instrumentation.instrumented
+        def fails():
+            instrumentation.countObjects()
+            raise ValueError('fails')
+
+        self.assertRaises(ValueError, fails)
+        self.assertEqual(self.metrics(), [('fails', 1, 0, logging.INFO)])
+        self.assertEqual(instrumentation._activeRecords(), [])
+
+    def test_metrics_file(self):
+        filename = os.path.join(self.tmp, 'metrics.jsonl')
+        os.environ[instrumentation.METRICS_ENV] = filename
+        for name in ('first', 'second'):
+            with instrumentation.instrument(name):
+                instrumentation.countObjects(5)
+        lines = open(filename).read().splitlines()
+        self.assertEqual(len(lines), 2)
+        data = json.loads(lines[1])
+        self.assertEqual((data['name'], data['objects'], data['depth']),
+                         ('second', 5, 0))
+        for key in ('started', 'wall', 'cpu', 'loads', 'stores',
+                    'peak_rss'):
+            self.failUnless(key in data, key)
+
+
+class TestProfiled(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.calls = []
+
+        @instrumentation.profiled
+        def helper(*args, **kw):
+            self.calls.append((args, kw))
+            return 'done'
+        self.helper = helper
+
+    def tearDown(self):
+        os.environ.pop(instrumentation.PROFILE_ENV, None)
+        shutil.rmtree(self.tmp)
+
+    def profiles(self, profile_dir):
+        if not os.path.isdir(profile_dir):
+            return []
+        return [name for name in os.listdir(profile_dir)
+                if name.endswith('.pstats')]
+
+    def test_not_profiled(self):
+        self.assertEqual(self.helper(1, a=2), 'done')
+        self.assertEqual(self.calls, [((1,), {'a': 2})])
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_profile_dir(self):
+        profile_dir = os.path.join(self.tmp, 'profiles')
+        self.assertEqual(self.helper(1, profile_dir=profile_dir), 'done')
+        self.assertEqual(self.calls, [((1,), {})])
+        profiles = self.profiles(profile_dir)
+        self.assertEqual(len(profiles), 1)
+        self.failUnless(profiles[0].startswith('helper-'))
+
+    def test_profile_env(self):
+        os.environ[instrumentation.PROFILE_ENV] = self.tmp
+        self.helper()
+        self.assertEqual(len(self.profiles(self.tmp)), 1)
+
+
+class TestPublishEverything(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'pub')
+        self.pub = self.folder.pub
+        for obj_id in ('a', 'b', 'c'):
+            self.pub.invokeFactory('Document', obj_id)
+        self.objs = [self.pub, self.pub.a, self.pub.b, self.pub.c]
+        self.path = '/'.join(self.pub.getPhysicalPath())
+
+    def test_batched(self):
+        helpers.publishEverything(path=self.path, batch_size=2,
+                                  savepoint=True)
+        self.assertEqual(self.review_states(self.objs), ['published'] * 4)
+
+    def test_review_state(self):
+        self.portal.portal_workflow.doActionFor(self.pub.a, 'submit')
+        helpers.publishEverything(path=self.path, review_state='private')
+        self.assertEqual(self.review_states(self.objs),
+                         ['published', 'pending', 'published', 'published'])
+
+    def test_not_recursive(self):
+        helpers.publishEverything(path=self.path, recursive=False)
+        self.assertEqual(self.review_states(self.objs),
+                         ['published', 'private', 'private', 'private'])
+
+
+class TestDates(unittest.TestCase):
+
+    def test_iso_string(self):
+        self.assertEqual(helpers._dateParts('2010-02-03 04:05'),
+                         ('2010-02-03 04:05:00', 2010, 2, 3, 4, 5))
+
+    def test_iso_string_matches_datetime(self):
+        date = DateTime('2010-02-03 04:05:06')
+        self.assertEqual(helpers._dateParts('2010-02-03 04:05:06')[0],
+                         date.ISO())
+
+    def test_datetime(self):
+        self.assertEqual(helpers._dateParts(datetime(2010, 2, 3, 4, 5, 6)),
+                         ('2010-02-03 04:05:06', 2010, 2, 3, 4, 5))
+
+    def test_zope_datetime(self):
+        date = DateTime('2010/02/03 04:05:00 GMT+1')
+        self.assertEqual(helpers._dateParts(date),
+                         (date.ISO(), 2010, 2, 3, 4, 5))
+
+    def test_cache(self):
+        cache = {}
+        parts = helpers._dateParts('2010-02-03', cache)
+        self.assertEqual(cache, {'2010-02-03': parts})
+        self.failUnless(helpers._dateParts('2010-02-03', cache) is parts)
+
+    def test_datesForProcessForm(self):
+        form = helpers.datesForProcessForm({'start': '2010-02-03 04:05'})
+        self.assertEqual(form, {
+            'start': '2010-02-03 04:05:00',
+            'start_year': 2010,
+            'start_month': 2,
+            'start_day': 3,
+            'start_hour': 4,
+            'start_minute': 5,
+        })
+
+    def test_fillDatesForProcessForm(self):
+        forms = [{'start': '2010-02-03'}, {'title': 'no dates'}]
+        helpers.fillDatesForProcessForm(forms, ['start', 'end'])
+        self.assertEqual(forms[0]['start_day'], 3)
+        self.assertEqual(forms[1], {'title': 'no dates'})
+
+
+class TestMissingAssets(unittest.TestCase):
+
+    def test_isAsset(self):
+        self.failUnless(isAsset('http://nohost/plone/foo.JS?version=1'))
+        self.failUnless(isAsset('portal_css/foo.css'))
+        self.failIf(isAsset('foo.jsx'))
+        self.failIf(isAsset('foo/css'))
+        self.failIf(isAsset(None))
+
+    def test_least_recently_missed_forgotten(self):
+        tracker = MissingAssetTracker(max_entries=2, interval=3600)
+        for entry in ('a.js', 'b.js', 'a.js', 'c.js'):
+            tracker.hit(entry)
+        self.assertEqual(tracker.top(), [('a.js', 2), ('c.js', 1)])
+        self.assertEqual(tracker.top(1), [('a.js', 2)])
+
+    def test_summary_rate_limited(self):
+        tracker = MissingAssetTracker(interval=3600)
+        tracker.hit('a.js')
+        # the first hit is summarized right away
+        self.assertEqual(tracker.pending, 0)
+        tracker.hit('a.js')
+        tracker.hit('b.css')
+        self.assertEqual(tracker.pending, 2)
+
+
+class TestMissingAssetsView(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.entries = monkeypatch.tracker.entries
+        monkeypatch.tracker.clear()
+        for entry in ('a.js', 'b.css', 'a.js'):
+            monkeypatch.tracker.hit(entry)
+
+    def beforeTearDown(self):
+        monkeypatch.tracker.clear()
+        monkeypatch.tracker.entries = self.entries
+
+    def test_view(self):
+        view = self.portal.restrictedTraverse('@@missing_assets')
+        self.assertEqual(view().splitlines(),
+                         ['       2  a.js', '       1  b.css'])
+        self.assertEqual(view(limit='1').splitlines(), ['       2  a.js'])
+
+
+class TestPaths(unittest.TestCase):
+
+    def test_outermostPaths(self):
+        self.assertEqual(
+            helpers._outermostPaths(['/plone/a', '/plone/a-b',
+                                     '/plone/a/c', '/plone/a']),
+            ['/plone/a', '/plone/a-b'])
+
+
+class TestResolvePackageReference(unittest.TestCase):
+
+    def setUp(self):
+        self.references = helpers._package_references.copy()
+
+    def tearDown(self):
+        helpers._package_references.clear()
+        helpers._package_references.update(self.references)
+
+    def test_resolve(self):
+        expected = os.path.join(os.path.dirname(sixfeetup.utils.__file__),
+                                'profiles/default')
+        self.assertEqual(helpers.resolvePackageReference(
+            ' sixfeetup.utils:profiles/default '), expected)
+        self.assertEqual(
+            helpers._package_references['sixfeetup.utils:profiles/default'],
+            expected)
+
+    def test_remembered(self):
+        helpers._package_references['no.such.package:file'] = '/remembered'
+        self.assertEqual(
+            helpers.resolvePackageReference('no.such.package:file'),
+            '/remembered')
+
+
+class TestWalkObjects(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'walk')
+        walk = self.folder.walk
+        for obj_id in ('b', 'a-b'):
+            walk.invokeFactory('Document', obj_id)
+        walk.invokeFactory('Folder', 'a')
+        walk.a.invokeFactory('Document', 'c')
+        self.path = '/'.join(walk.getPhysicalPath())
+
+    def ids(self, objs, brains_only=True):
+        if brains_only:
+            return [brain.getId for brain in objs]
+        return [obj.getId() for obj in objs]
+
+    def test_path_order(self):
+        brains = helpers.walkObjects(path=self.path, unrestricted=True,
+                                     brains_only=True, portal=self.portal)
+        self.assertEqual(len(brains), 5)
+        self.assertEqual(self.ids(brains), ['walk', 'a', 'c', 'a-b', 'b'])
+
+    def test_start_after(self):
+        objs = helpers.walkObjects(path=self.path,
+                                   start_after=self.path + '/a/c',
+                                   portal=self.portal)
+        self.assertEqual(len(objs), 2)
+        self.assertEqual(self.ids(objs, False), ['a-b', 'b'])
+        objs = helpers.walkObjects(path=self.path,
+                                   start_after=self.path + '/a',
+                                   portal=self.portal)
+        self.assertEqual(self.ids(objs, False), ['c', 'a-b', 'b'])
+
+    def test_query(self):
+        brains = helpers.walkObjects({'portal_type': 'Document'},
+                                     path=self.path, brains_only=True,
+                                     portal=self.portal)
+        self.assertEqual(len(brains), 3)
+        self.assertEqual(self.ids(brains), ['c', 'a-b', 'b'])
+
+    def test_not_recursive(self):
+        brains = helpers.walkObjects(path=self.path + '/a', recursive=False,
+                                     brains_only=True, portal=self.portal)
+        self.assertEqual(self.ids(brains), ['a'])
+
+    def test_uncataloged_below(self):
+        self.folder.walk.a.unindexObject()
+        brains = helpers.walkObjects(path=self.path, brains_only=True,
+                                     portal=self.portal)
+        self.assertEqual(self.ids(brains), ['walk', 'c', 'a-b', 'b'])
+
+
+class TestClearLocks(TestCase):
+
+    def afterSetUp(self):
+        from plone.locking.interfaces import ILockable
+        TestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'locks')
+        for obj_id in ('a', 'b'):
+            self.folder.locks.invokeFactory('Document', obj_id)
+        ILockable(self.folder.locks.a).lock()
+        self.path = '/'.join(self.folder.locks.getPhysicalPath())
+
+    def test_clearLocks(self):
+        self.failUnless(self.folder.locks.a.wl_isLocked())
+        self.assertEqual(helpers.clearLocks(path=self.path), 1)
+        self.failIf(self.folder.locks.a.wl_isLocked())
+        self.assertEqual(helpers.clearLocks(path=self.path), 0)
+
+    def test_unknown_lock_index(self):
+        self.assertEqual(helpers.clearLocks(path=self.path,
+                                            lock_index='no_such_index'), 1)
+        self.failIf(self.folder.locks.a.wl_isLocked())
+
+
+class TestImportUserAccounts(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.members = [
+            {'id': 'joe', 'password': 'secret12', 'roles': ['Member'],
+             'properties': {'email': 'joe@example.com', 'fullname': 'Joe'}},
+            {'id': ptc.default_user, 'password': 'secret12', 'roles': [],
+             'properties': {'email': 'taken@example.com'}},
+        ]
+        self.tmp = tempfile.mkdtemp()
+
+    def beforeTearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def writeFile(self, name, data):
+        filename = os.path.join(self.tmp, name)
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+        return filename
+
+    def test_import(self):
+        result = helpers.importUserAccounts(self.members, batch_size=None)
+        self.assertEqual(result, {'added': 1, 'skipped': 1})
+        member = self.portal.portal_membership.getMemberById('joe')
+        self.assertEqual(member.getProperty('fullname'), 'Joe')
+
+    def test_taken_without_prefetch(self):
+        result = helpers.importUserAccounts(self.members, batch_size=None,
+                                            prefetch_ids=False)
+        self.assertEqual(result, {'added': 1, 'skipped': 1})
+
+    def test_read_csv(self):
+        filename = self.writeFile(
+            'members.csv', 'id,password,roles,email\r\n'
+                           'joe,secret12,Member; Reviewer,joe@example.com\r\n')
+        self.assertEqual(list(helpers.readMemberDicts(filename)), [
+            {'id': 'joe', 'password': 'secret12',
+             'roles': ['Member', 'Reviewer'],
+             'properties': {'email': 'joe@example.com'}}])
+
+    def test_read_json_lines(self):
+        filename = self.writeFile(
+            'members.jsonl', '{"id": "joe", "password": "secret12"}\n\n'
+                             '{"id": "jane", "password": "secret12"}\n')
+        self.assertEqual(
+            [mem['id'] for mem in helpers.readMemberDicts(filename)],
+            ['joe', 'jane'])
+        self.assertRaises(ValueError, list,
+                          helpers.readMemberDicts(filename, 'xml'))
+
+
+class TestPauseIndexing(TestCase):
+    """addRememberUserAccounts needs remember, the indexing it does is
+    checked with documents
+    """
+
+    def test_indexed_once_resumed(self):
+        catalog = self.portal.portal_catalog
+        paused = helpers._pauseIndexing(self.portal, 'Document')
+        try:
+            self.folder.invokeFactory('Document', 'quiet')
+            doc = self.folder.quiet
+            doc.processForm(values={'title': 'Quiet'})
+            self.portal.portal_workflow.doActionFor(doc, 'publish')
+            path = '/'.join(doc.getPhysicalPath())
+            self.assertEqual(
+                len(catalog.unrestrictedSearchResults(path=path)), 0)
+        finally:
+            helpers._resumeIndexing(paused)
+        self.failIf('Document' in self.portal.archetype_tool.catalog_map)
+        helpers._reindexMembers([doc])
+        brains = catalog.unrestrictedSearchResults(path=path)
+        self.assertEqual([(brain.Title, brain.review_state)
+                          for brain in brains], [('Quiet', 'published')])
+
+    def test_mapped_catalogs_restored(self):
+        at = self.portal.archetype_tool
+        at.setCatalogsByType('Document', ['portal_catalog'])
+        helpers._resumeIndexing(helpers._pauseIndexing(self.portal,
+                                                       'Document'))
+        self.assertEqual(at.catalog_map['Document'], ['portal_catalog'])
+
+
+class TestReferenceUtils(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        for obj_id, title in (('a', 'Zulu'), ('b', 'Alpha'), ('c', 'Mike'),
+                              ('source', 'Source')):
+            self.folder.invokeFactory('Document', obj_id, title=title)
+        self.a, self.b, self.c, self.source = [
+            self.folder[obj_id] for obj_id in ('a', 'b', 'c', 'source')]
+        self.source.setRelatedItems([self.a, self.b, self.c])
+        self.view = self.folder.restrictedTraverse('@@reference_utils')
+
+    def ids(self, objs):
+        return [obj.getId() for obj in objs]
+
+    def newRequest(self):
+        from zope.annotation.interfaces import IAnnotations
+        from sixfeetup.utils.browser.references import MEMO_KEY
+        IAnnotations(self.view.request).pop(MEMO_KEY, None)
+
+    def test_sort_on(self):
+        refs = self.view.getFilteredRefs(self.source, 'relatesTo', 'title')
+        self.assertEqual(self.ids(refs), ['b', 'c', 'a'])
+        refs = self.view.getFilteredRefs(self.source, 'relatesTo', 'title',
+                                         reverse=True)
+        self.assertEqual(self.ids(refs), ['a', 'c', 'b'])
+
+    def test_back_references(self):
+        brefs = self.view.getFilteredBRefs(self.a, 'relatesTo')
+        self.assertEqual(self.ids(brefs), ['source'])
+
+    def test_remembered_for_the_request(self):
+        refs = self.view.getFilteredRefs(self.source, 'relatesTo', 'title')
+        self.source.setRelatedItems([self.a])
+        self.assertEqual(
+            self.view.getFilteredRefs(self.source, 'relatesTo', 'title'),
+            refs)
+        self.newRequest()
+        self.assertEqual(self.ids(self.view.getFilteredRefs(
+            self.source, 'relatesTo', 'title')), ['a'])
+
+    def setOrder(self, ids):
+        """Order the references like an OrderableReferenceField does
+        """
+        for ref in self.source.getReferenceImpl('relatesTo'):
+            ref.order = ids.index(ref.getTargetObject().getId())
+
+    def test_ref_brains(self):
+        brains = self.view.getFilteredRefBrains(self.source, 'relatesTo',
+                                                'sortable_title')
+        self.assertEqual([brain.getId for brain in brains], ['b', 'c', 'a'])
+        brains = self.view.getFilteredRefBrains(
+            self.source, 'relatesTo', 'sortable_title', reverse=True,
+            b_start=1, b_size=1)
+        self.assertEqual([brain.getId for brain in brains], ['c'])
+
+    def test_ref_brains_in_reference_order(self):
+        brains = self.view.getFilteredRefBrains(self.source, 'relatesTo')
+        self.assertEqual([brain.getId for brain in brains],
+                         self.ids(self.view.getFilteredRefs(self.source,
+                                                            'relatesTo')))
+
+    def test_bref_brains(self):
+        brains = self.view.getFilteredBRefBrains(self.a, 'relatesTo')
+        self.assertEqual([brain.getId for brain in brains], ['source'])
+
+    def test_ordered_ref_brains(self):
+        self.setOrder(['c', 'a', 'b'])
+        brains = self.view.getFilteredOrderedRefBrains(self.source,
+                                                       'relatesTo')
+        self.assertEqual([brain.getId for brain in brains], ['c', 'a', 'b'])
+        brains = self.view.getFilteredOrderedRefBrains(
+            self.source, 'relatesTo', reverse=True, b_size=2)
+        self.assertEqual([brain.getId for brain in brains], ['b', 'a'])
+
+    def test_brains_filtered(self):
+        self.logout()
+        self.assertEqual(len(self.view.getFilteredRefBrains(
+            self.source, 'relatesTo', 'sortable_title')), 0)
+
+    def test_refs_batch(self):
+        batch = self.view.getFilteredRefsBatch(self.source, 'relatesTo',
+                                               'title', start=1, size=1)
+        self.assertEqual(self.ids(batch), ['c'])
+        self.assertEqual(batch.total, 3)
+        batch = self.view.getFilteredRefsBatch(self.source, 'relatesTo',
+                                               size=2)
+        self.assertEqual(self.ids(batch), self.ids(
+            self.view.getFilteredRefs(self.source, 'relatesTo'))[:2])
+
+    def test_ordered_refs_batch(self):
+        self.setOrder(['c', 'a', 'b'])
+        batch = self.view.getFilteredOrderedRefsBatch(
+            self.source, 'relatesTo', reverse=True, start=1, size=5)
+        self.assertEqual(self.ids(batch), ['a', 'c'])
+        self.assertEqual(batch.total, 3)
+
+    def test_ordered_brefs(self):
+        self.folder.invokeFactory('Document', 'other')
+        self.folder.other.setRelatedItems([self.a])
+        for ref in self.a.getBackReferenceImpl('relatesTo'):
+            ref.order = ['other', 'source'].index(
+                ref.getSourceObject().getId())
+        self.assertEqual(
+            self.ids(self.view.getFilteredOrderedBRefs(self.a, 'relatesTo')),
+            ['other', 'source'])
+        batch = self.view.getFilteredOrderedBRefsBatch(self.a, 'relatesTo')
+        self.assertEqual(self.ids(batch), ['other', 'source'])
+        batch = self.view.getFilteredOrderedBRefsBatch(
+            self.a, 'relatesTo', reverse=True, size=1)
+        self.assertEqual(self.ids(batch), ['source'])
+        self.assertEqual(batch.total, 2)
+
+    def test_cached(self):
+        refs = self.view.getFilteredRefs(self.source, 'relatesTo', 'title',
+                                         cached=True)
+        self.assertEqual(self.ids(refs), ['b', 'c', 'a'])
+        # changing the references invalidates the cache
+        self.source.setRelatedItems([self.c])
+        self.newRequest()
+        self.assertEqual(self.ids(self.view.getFilteredRefs(
+            self.source, 'relatesTo', 'title', cached=True)), ['c'])
+
+
+class TestRemoveCustomContent(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.custom = self.portal.portal_skins.custom
+        for obj_id in ('plone.css', 'plonePrint.css', 'main.js', 'foo_bar',
+                       'keep'):
+            self.custom.manage_addProduct['OFSP'].manage_addFile(obj_id)
+
+    def test_glob_dry_run(self):
+        removed = helpers.removeCustomContent(del_args=['plone*.css'],
+                                              dry_run=True)
+        self.assertEqual(removed, ['plone.css', 'plonePrint.css'])
+        self.failUnless('plone.css' in self.custom.objectIds())
+
+    def test_regular_expression(self):
+        removed = helpers.removeCustomContent(del_args=['re:^foo_'])
+        self.assertEqual(removed, ['foo_bar'])
+        self.failIf('foo_bar' in self.custom.objectIds())
+
+    def test_ids_and_missing(self):
+        removed = helpers.removeCustomContent(
+            del_args=['keep', 'missing', 'main.js'])
+        self.assertEqual(removed, ['main.js', 'keep'])
+        remaining = self.custom.objectIds()
+        self.failIf('keep' in remaining)
+        self.failIf('main.js' in remaining)
+        self.failUnless('foo_bar' in remaining)
+
+    def test_batches(self):
+        notes = []
+        commit = helpers._commitBatch
+        helpers._commitBatch = lambda portal, note: notes.append(note)
+        try:
+            removed = helpers.removeCustomContent(
+                del_args=['*.css', 'main.js'], batch_size=2)
+        finally:
+            helpers._commitBatch = commit
+        self.assertEqual(removed, ['plone.css', 'plonePrint.css', 'main.js'])
+        self.assertEqual(notes, ['removeCustomContent: 2 objects',
+                                 'removeCustomContent: 3 objects'])
+
+
+def _upgradeOk(setup_tool):
+    pass
+
+
+def _upgradeFails(setup_tool):
+    raise ValueError('upgrade failed')
+
+
+class TestUpdateSchemaBatched(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'schemas')
+        self.folder.schemas.invokeFactory('Document', 'doc')
+        self.doc = self.folder.schemas.doc
+        self.doc.schema = self.doc.schema.copy()
+        self.path = '/'.join(self.folder.schemas.getPhysicalPath())
+
+    def update(self, **kw):
+        return helpers.updateSchemaBatched(['ATContentTypes.ATDocument'],
+                                           path=self.path, batch_size=None,
+                                           **kw)
+
+    def test_remove_instance_schema(self):
+        self.assertEqual(self.update(), {'updated': 1, 'current': 0})
+        self.failIf('schema' in aq_base(self.doc).__dict__)
+        self.assertEqual(self.update(), {'updated': 0, 'current': 1})
+
+    def test_keep_instance_schema(self):
+        self.assertEqual(self.update(remove_inst_schemas=False),
+                         {'updated': 0, 'current': 1})
+        self.failUnless('schema' in aq_base(self.doc).__dict__)
+
+    def test_unknown_type(self):
+        result = helpers.updateSchemaBatched(['NoSuch.Type'], path=self.path)
+        self.assertEqual(result, {'updated': 0, 'current': 0})
+
+
+class TestSetPolicyOnObjects(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.portal.portal_setup.runAllImportStepsFromProfile(
+            'profile-Products.CMFPlacefulWorkflow:CMFPlacefulWorkflow')
+        self.folder.invokeFactory('Folder', 'policy')
+        self.folder.policy.invokeFactory('Document', 'doc')
+        self.path = '/'.join(self.folder.policy.getPhysicalPath())
+
+    def config(self):
+        placeful = self.portal.portal_placeful_workflow
+        return placeful.getWorkflowPolicyConfig(self.folder.policy)
+
+    def test_set_policies(self):
+        result = helpers.setPolicyOnObjects(
+            [self.path], policy_in='one-state', policy_below='one-state')
+        self.assertEqual((result['set'], result['skipped']),
+                         ([self.path], []))
+        self.assertEqual(result['checked'], 2)
+        wtool = self.portal.portal_workflow
+        self.assertEqual(tuple(wtool.getChainFor(self.folder.policy.doc)),
+                         ('one_state_workflow',))
+
+    def test_unchanged_policies(self):
+        helpers.setPolicyOnObjects([self.folder.policy],
+                                   policy_in='one-state')
+        result = helpers.setPolicyOnObjects([self.path],
+                                            policy_in='one-state')
+        self.assertEqual(result, {'set': [], 'skipped': [self.path],
+                                  'checked': 0, 'changed': 0})
+
+    def test_update_existing(self):
+        helpers.setPolicyOnObjects([self.path], policy_in='one-state')
+        result = helpers.setPolicyOnObjects([self.path],
+                                            policy_in='intranet',
+                                            update_existing=False)
+        self.assertEqual(result['skipped'], [self.path])
+        self.assertEqual(self.config().getPolicyInId(), 'one-state')
+        result = helpers.setPolicyOnObjects([self.path],
+                                            policy_in='intranet')
+        self.assertEqual(result['set'], [self.path])
+        # without policy_below only the folder itself is updated
+        self.assertEqual(result['checked'], 1)
+        self.assertEqual(self.config().getPolicyInId(), 'intranet')
+
+
+class TestUpdateSecurity(FunctionalTestCase):
+
+    def afterSetUp(self):
+        FunctionalTestCase.afterSetUp(self)
+        for folder_id in ('inside', 'outside'):
+            self.folder.invokeFactory('Folder', folder_id)
+            folder = getattr(self.folder, folder_id)
+            folder.invokeFactory('Document', 'doc')
+            folder.doc.manage_permission('View', ['Manager'], acquire=0)
+        self.path = '/'.join(self.folder.inside.getPhysicalPath())
+
+    def viewers(self, folder_id):
+        doc = getattr(self.folder, folder_id).doc
+        return sorted(role['name'] for role in doc.rolesOfPermission('View')
+                      if role['selected'])
+
+    def test_scoped(self):
+        helpers.updateSecurity(path=self.path,
+                               workflow_ids=['simple_publication_workflow'],
+                               batch_size=1)
+        self.failIf(self.viewers('inside') == ['Manager'])
+        self.assertEqual(self.viewers('outside'), ['Manager'])
+
+    def test_counts(self):
+        result = helpers._updateSecurityForPaths(
+            self.portal, [self.path, self.path + '/doc'], batch_size=1)
+        self.assertEqual(result, {'checked': 2, 'changed': 1})
+
+    def test_unused_workflow(self):
+        helpers.updateSecurity(path=self.path,
+                               workflow_ids=['one_state_workflow'])
+        self.assertEqual(self.viewers('inside'), ['Manager'])
+
+
+class _AssetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('/* cooked */')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrewarmAssets(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _AssetHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_aborted(self):
+        self.assertEqual(helpers._prewarmAssets(False, [self.url + '/a']), 0)
+
+    def test_prewarm(self):
+        urls = ['%s/%s.css' % (self.url, name) for name in 'abcde']
+        urls.append(self.url + '/missing.css')
+        self.assertEqual(helpers._prewarmAssets(True, urls, threads=2,
+                                                timeout=10), 5)
+
+
+class TestRefreshAssetRegistry(TestCase):
+
+    def afterSetUp(self):
+        TestCase.afterSetUp(self)
+        self.cooked = []
+        registry = self.portal.portal_css
+        registry.cookResources = lambda: self.cooked.append(True)
+
+    def test_unchanged(self):
+        helpers.refreshAssetRegistry(['css'])
+        helpers.refreshAssetRegistry(['css'])
+        self.assertEqual(len(self.cooked), 1)
+        helpers.refreshAssetRegistry(['css'], force=True)
+        self.assertEqual(len(self.cooked), 2)
+
+    def test_prewarm_hook(self):
+        helpers.refreshAssetRegistry(['css'],
+                                     prewarm_url='http://example.com/',
+                                     prewarm_threads=2)
+        hooks = [(args, kw) for hook, args, kw
+                 in transaction.get().getAfterCommitHooks()
+                 if hook is helpers._prewarmAssets]
+        self.assertEqual(len(hooks), 1)
+        urls, threads = hooks[0][0]
+        self.assertEqual(threads, 2)
+        self.failUnless(urls)
+        for url in urls:
+            self.failUnless(url.startswith('http://example.com/portal_css/'))
+
+
+class TestRunUpgradeSteps(TestCase):
+
+    profile_id = 'sixfeetup.utils:tests'
+
+    def afterSetUp(self):
+        from Products.GenericSetup import EXTENSION
+        from Products.GenericSetup.registry import _profile_registry
+        TestCase.afterSetUp(self)
+        self.profile_dir = tempfile.mkdtemp()
+        f = open(os.path.join(self.profile_dir, 'metadata.xml'), 'w')
+        f.write('<?xml version="1.0"?>\n'
+                '<metadata>\n <version>4</version>\n</metadata>\n')
+        f.close()
+        _profile_registry.registerProfile(
+            'tests', 'sixfeetup.utils tests', '', self.profile_dir,
+            'sixfeetup.utils', EXTENSION)
+        self.registerStep('to 2', '1', '2', _upgradeOk)
+        self.registerStep('any', '*', '*', _upgradeOk)
+        self.setup_tool = self.portal.portal_setup
+        self.setup_tool.setLastVersionForProfile(self.profile_id, '1')
+
+    def beforeTearDown(self):
+        from Products.GenericSetup.registry import _profile_registry
+        from Products.GenericSetup.upgrade import _upgrade_registry
+        _upgrade_registry.getUpgradeStepsForProfile(self.profile_id).clear()
+        _profile_registry.unregisterProfile('tests', 'sixfeetup.utils')
+        shutil.rmtree(self.profile_dir)
+
+    def registerStep(self, title, source, dest, handler):
+        from Products.GenericSetup.upgrade import UpgradeStep
+        from Products.GenericSetup.upgrade import _registerUpgradeStep
+        _registerUpgradeStep(UpgradeStep(title, self.profile_id, source,
+                                         dest, '', handler))
+
+    def lastVersion(self):
+        return self.setup_tool.getLastVersionForProfile(self.profile_id)
+
+    def test_dry_run(self):
+        self.registerStep('to 3', '2', '3', _upgradeOk)
+        report = helpers.runUpgradeSteps(self.profile_id, dry_run=True)
+        self.assertEqual([(step['source'], step['dest'])
+                          for step in report['steps']],
+                         [('*', '*'), ('1', '2'), ('2', '3')])
+        self.assertEqual(self.lastVersion(), ('1',))
+
+    def test_all_steps_completed(self):
+        self.registerStep('to 3', '2', '3', _upgradeOk)
+        report = helpers.runUpgradeSteps(self.profile_id)
+        self.assertEqual([step['status'] for step in report['steps']],
+                         ['done'] * 3)
+        # the version of the profile, not the one of the last step
+        self.assertEqual(report['version'], '4')
+        self.assertEqual(self.lastVersion(), ('4',))
+
+    def test_version_of_last_completed_step(self):
+        self.registerStep('to 3', '2', '3', _upgradeFails)
+        self.assertRaises(ValueError, helpers.runUpgradeSteps,
+                          self.profile_id)
+        self.assertEqual(self.lastVersion(), ('2',))
+
+
+class TestBulkTransition(FunctionalTestCase):
+
+    def afterSetUp(self):
+        FunctionalTestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'bulk')
+        self.bulk = self.folder.bulk
+        for obj_id in ('a', 'b', 'c'):
+            self.bulk.invokeFactory('Document', obj_id)
+        self.objs = [self.bulk, self.bulk.a, self.bulk.b, self.bulk.c]
+        self.path = '/'.join(self.bulk.getPhysicalPath())
+
+    def test_checkpoints(self):
+        self.assertEqual(helpers.getCheckpoint('bulk', self.portal), None)
+        helpers.setCheckpoint('bulk', self.path + '/b', 42, 3, self.portal)
+        self.assertEqual(helpers.getCheckpoint('bulk', self.portal),
+                         {'path': self.path + '/b', 'rid': 42, 'count': 3})
+        helpers.clearCheckpoint('bulk', self.portal)
+        self.assertEqual(helpers.getCheckpoint('bulk', self.portal), None)
+
+    def test_batches(self):
+        helpers.bulkTransition(path=self.path, batch_size=3,
+                               checkpoint='bulk')
+        self.assertEqual(self.review_states(self.objs), ['published'] * 4)
+        self.assertEqual(helpers.getCheckpoint('bulk', self.portal), None)
+
+    def test_no_batches(self):
+        helpers.bulkTransition(path=self.path, batch_size=None,
+                               checkpoint='bulk')
+        self.assertEqual(self.review_states(self.objs), ['published'] * 4)
+
+    def test_resume(self):
+        helpers.setCheckpoint('bulk', self.path + '/b', None, 3,
+                              self.portal)
+        helpers.bulkTransition(path=self.path, checkpoint='bulk')
+        self.assertEqual(self.review_states(self.objs),
+                         ['private', 'private', 'private', 'published'])
+        self.assertEqual(helpers.getCheckpoint('bulk', self.portal), None)
+
+
+class TestReindexIndexes(FunctionalTestCase):
+
+    def afterSetUp(self):
+        FunctionalTestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'idx')
+        for obj_id in ('a', 'b'):
+            self.folder.idx.invokeFactory('Document', obj_id,
+                                          title=obj_id.upper())
+            self.folder.idx[obj_id].reindexObject()
+        self.path = '/'.join(self.folder.idx.getPhysicalPath())
+        self.catalog = self.portal.portal_catalog
+
+    def test_only_changed(self):
+        # changed without reindexing
+        self.folder.idx.a.setTitle('Zebra')
+        result = helpers.reindexIndexes(indexes=['sortable_title'],
+                                        metadata=['Title'], path=self.path)
+        self.assertEqual(result, {'touched': 1, 'skipped': 2})
+        brains = self.catalog.unrestrictedSearchResults(
+            path=self.path, sortable_title='zebra')
+        self.assertEqual([brain.Title for brain in brains], ['Zebra'])
+
+    def test_metadata_only(self):
+        self.folder.idx.b.setDescription('new')
+        result = helpers.reindexIndexes(metadata=['Description'],
+                                        path=self.path, portal_type='Document')
+        self.assertEqual(result, {'touched': 1, 'skipped': 1})
+        brains = self.catalog.unrestrictedSearchResults(
+            path=self.path + '/b')
+        self.assertEqual(brains[0].Description, 'new')
+
+    def test_unknown_names(self):
+        result = helpers.reindexIndexes(indexes=['no_such_index'],
+                                        metadata=['no_such_column'])
+        self.assertEqual(result, {'touched': 0, 'skipped': 0})
+
+
+def _openZEO(addr):
+    from ZEO.ClientStorage import ClientStorage
+    from ZODB import DB
+    return DB(ClientStorage(addr))
+
+
+class TestParallelRebuildCatalog(FunctionalTestCase):
+    """The workers need a storage they can share, so the site is copied
+    to a FileStorage served by ZEO and rebuilt there
+    """
+
+    def afterSetUp(self):
+        from OFS.Application import Application
+        from Testing.makerequest import makerequest
+        from ZEO.tests import forker
+        FunctionalTestCase.afterSetUp(self)
+        self.folder.invokeFactory('Folder', 'shard')
+        for obj_id in ('a', 'b', 'c'):
+            self.folder.shard.invokeFactory('Document', obj_id)
+        self.shard_path = '/'.join(self.folder.shard.getPhysicalPath())
+        transaction.commit()
+        data = tempfile.TemporaryFile()
+        self.portal._p_jar.exportFile(self.portal._p_oid, data)
+        data.seek(0)
+
+        self.tmp = tempfile.mkdtemp()
+        self.addr, self.adminaddr, self.pid, self.conf = \
+            forker.start_zeo_server(port=forker.get_port(),
+                                    path=os.path.join(self.tmp, 'Data.fs'))
+        self.db = _openZEO(self.addr)
+        self.conn = self.db.open()
+        root = self.conn.root()
+        root['Application'] = Application()
+        app = root['Application']
+        portal = self.conn.importFile(data)
+        app._setOb(portal.getId(), portal)
+        transaction.commit()
+        data.close()
+        self.site = makerequest(app)[portal.getId()]
+        setSite(self.site)
+
+    def beforeTearDown(self):
+        from ZEO.tests import forker
+        transaction.abort()
+        setSite(self.portal)
+        self.conn.close()
+        self.db.close()
+        forker.shutdown_zeo_server(self.adminaddr)
+        os.waitpid(self.pid, 0)
+        os.remove(self.conf)
+        shutil.rmtree(self.tmp)
+
+    def catalogedPaths(self):
+        return sorted(self.site.portal_catalog._catalog.uids.keys())
+
+    def test_same_as_serial_rebuild(self):
+        from sixfeetup.utils.parallel import parallelRebuildCatalog
+        results = parallelRebuildCatalog(
+            processes=2, batch_size=2, db_factory=partial(_openZEO,
+                                                          self.addr))
+        self.assertEqual([result[3] for result in results],
+                         [None] * len(results))
+        parallel = self.catalogedPaths()
+        self.failUnless(self.shard_path + '/c' in parallel)
+        helpers.clearAndRebuildCatalog()
+        self.assertEqual(self.catalogedPaths(), parallel)
+
+
+class TestTogglePASPlugins(TestCase):
+
+    meta_types = ('ZODB User Manager',)
+    interfaces = ('IAuthenticationPlugin', 'IUserAdderPlugin')
+
+    def afterSetUp(self):
+        from Products.PluggableAuthService.interfaces import plugins
+        TestCase.afterSetUp(self)
+        self.plugins = self.portal.acl_users.plugins
+        self.auth = plugins.IAuthenticationPlugin
+        self.adder = plugins.IUserAdderPlugin
+        # source_users first, and not active for adding users
+        self.plugins.movePluginsUp(self.auth, ['source_users'])
+        if 'source_users' in self.plugins.listPluginIds(self.adder):
+            self.plugins.deactivatePlugin(self.adder, 'source_users')
+        self.before = self.plugins.listPluginIds(self.auth)
+
+    def toggle(self, enable, restore=None):
+        return helpers.togglePASPlugins(self.portal, self.meta_types,
+                                        enable, self.interfaces,
+                                        restore=restore)
+
+    def test_disable(self):
+        changes = self.toggle(False)
+        self.assertEqual([change[1:4] for change in changes],
+                         [('source_users', 'IAuthenticationPlugin',
+                           'disabled')])
+        self.failIf('source_users' in self.plugins.listPluginIds(self.auth))
+
+    def test_enable_restores_order(self):
+        self.toggle(False)
+        self.toggle(True)
+        self.assertEqual(self.plugins.listPluginIds(self.auth), self.before)
+        self.failIf('source_users' in self.plugins.listPluginIds(self.adder))
+
+    def test_enable_from_changes(self):
+        from zope.annotation.interfaces import IAnnotations
+        changes = self.toggle(False)
+        del IAnnotations(self.portal)[helpers.DISABLED_PLUGINS_KEY]
+        self.toggle(True, restore=changes)
+        self.assertEqual(self.plugins.listPluginIds(self.auth), self.before)
+        self.failIf('source_users' in self.plugins.listPluginIds(self.adder))
+
+    def test_enable_some_interfaces(self):
+        from Products.PluggableAuthService.interfaces import plugins
+        from zope.annotation.interfaces import IAnnotations
+        enumeration = plugins.IUserEnumerationPlugin
+        interfaces = self.interfaces + ('IUserEnumerationPlugin',)
+        helpers.togglePASPlugins(self.portal, self.meta_types, False,
+                                 interfaces)
+        changes = self.toggle(True)
+        self.assertEqual([change[1:4] for change in changes],
+                         [('source_users', 'IAuthenticationPlugin',
+                           'enabled')])
+        self.assertEqual(self.plugins.listPluginIds(self.auth), self.before)
+        self.failIf(
+            'source_users' in self.plugins.listPluginIds(enumeration))
+        annotations = IAnnotations(self.portal)
+        self.assertEqual(
+            [change[1:4] for change
+             in annotations[helpers.DISABLED_PLUGINS_KEY]],
+            [('source_users', 'IUserEnumerationPlugin', 'disabled')])
+        helpers.togglePASPlugins(self.portal, self.meta_types, True,
+                                 interfaces)
+        self.failUnless(
+            'source_users' in self.plugins.listPluginIds(enumeration))
+        self.failIf(helpers.DISABLED_PLUGINS_KEY in annotations)
+
+
+def _retitleSite(title):
+    getSite().manage_changeProperties(title=title)
+
+
+def _failOnSite():
+    getSite().manage_changeProperties(title='Half done')
+    raise ValueError('site failed')
+
+
+class TestRunOnAllSites(FunctionalTestCase):
+
+    def afterSetUp(self):
+        FunctionalTestCase.afterSetUp(self)
+        self.app.manage_addFolder('sites')
+        self.title = self.portal.Title()
+        self.portal_path = '/'.join(self.portal.getPhysicalPath())
+
+    def test_findPloneSites(self):
+        self.assertEqual(helpers.findPloneSites(self.app), [self.portal])
+
+    def test_dotted_name(self):
+        results = helpers.runOnAllSites('sixfeetup.utils.tests._retitleSite',
+                                        root=self.app, args=('Renamed',))
+        self.assertEqual([(result['site'], result['status'])
+                          for result in results],
+                         [(self.portal_path, 'ok')])
+        self.assertEqual(self.portal.Title(), 'Renamed')
+        self.failUnless(getSite() is self.portal)
+
+    def test_failing_helper(self):
+        results = helpers.runOnAllSites(_failOnSite, root=self.app)
+        self.assertEqual([(result['site'], result['status'], result['error'])
+                          for result in results],
+                         [(self.portal_path, 'failed',
+                           'ValueError: site failed')])
+        self.assertEqual(self.portal.Title(), self.title)
+        self.failUnless(getSite() is self.portal)
+
 
 def test_suite():
     return unittest.TestSuite([
@@ -39,6 +1174,9 @@ def test_suite():
         #    setUp=testing.setUp, tearDown=testing.tearDown),
 
 
+        unittest.makeSuite(TestInstrumentation),
+        unittest.makeSuite(TestProfiled),
+
         # Integration tests that use PloneTestCase
         #ztc.ZopeDocFileSuite(
         #    'README.txt', package='sixfeetup.utils',
@@ -48,6 +1186,30 @@ def test_suite():
         #    'browser.txt', package='sixfeetup.utils',
         #    test_class=TestCase),
 
+        unittest.makeSuite(TestDates),
+        unittest.makeSuite(TestMissingAssets),
+        unittest.makeSuite(TestMissingAssetsView),
+        unittest.makeSuite(TestPaths),
+        unittest.makeSuite(TestResolvePackageReference),
+        unittest.makeSuite(TestWalkObjects),
+        unittest.makeSuite(TestPublishEverything),
+        unittest.makeSuite(TestClearLocks),
+        unittest.makeSuite(TestImportUserAccounts),
+        unittest.makeSuite(TestPauseIndexing),
+        unittest.makeSuite(TestReferenceUtils),
+        unittest.makeSuite(TestRemoveCustomContent),
+        unittest.makeSuite(TestTogglePASPlugins),
+        unittest.makeSuite(TestRunUpgradeSteps),
+        unittest.makeSuite(TestUpdateSchemaBatched),
+        unittest.makeSuite(TestSetPolicyOnObjects),
+        unittest.makeSuite(TestUpdateSecurity),
+        unittest.makeSuite(TestPrewarmAssets),
+        unittest.makeSuite(TestRefreshAssetRegistry),
+        unittest.makeSuite(TestBulkTransition),
+        unittest.makeSuite(TestParallelRebuildCatalog),
+        unittest.makeSuite(TestReindexIndexes),
+        unittest.makeSuite(TestRunOnAllSites),
+
         ])
 
 if __name__ == '__main__':